@@ -1,11 +1,15 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_from_directory, Response, stream_with_context
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
 
 from cosmos import test_upload_json_files, run_cosmos_queries as run_queries
-from azure_openai_agent import query_azure_openai_with_history
+from azure_openai_agent import query_azure_openai_with_history, stream_azure_openai_with_history
 
 import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__, static_folder='static', static_url_path='')
 # Enable CORS properly with specific origins
@@ -52,6 +56,26 @@ def api_query():
         print(f"API Error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# Streams the response as server-sent events so the client can render it while it is generated
+@app.route("/api/query/stream", methods=["POST"])
+def api_query_stream():
+    data = request.json
+    if not data or "query" not in data:
+        return jsonify({"error": "Invalid request. 'query' field is required"}), 400
+
+    conversation_history = data.get("conversation_history", [])
+
+    def generate():
+        try:
+            for chunk in stream_azure_openai_with_history(data["query"], conversation_history, lambda message, isCode=False: logger.debug(message)):
+                yield f"data: {json.dumps({'response': chunk})}\n\n"
+        except Exception as e:
+            print(f"API Error: {str(e)}")
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream")
+
 # Make sure this is below the API routes
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -1,10 +1,14 @@
 import os
-import json
+import orjson
+import threading
+from collections import OrderedDict
+import httpx
 from dotenv import load_dotenv
 from openai import AzureOpenAI
-from azure.cosmos import CosmosClient
 from azure.core.exceptions import AzureError
 
+from cosmos import get_container
+
 # Load environment variables
 load_dotenv()
 
@@ -25,11 +29,20 @@ subscription_key = os.getenv("AZURE_OPENAI_API_KEY")
 if not subscription_key:
     raise ValueError("AZURE_OPENAI_API_KEY environment variable is not set.")
 
+# Long-lived HTTP/2 client so every request reuses pooled keep-alive connections
+# instead of paying a new TLS handshake per call
+http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=32),
+    timeout=httpx.Timeout(120.0, connect=5.0),
+)
+
 # Initialize Azure OpenAI client
 client = AzureOpenAI(
     api_version=api_version,
     azure_endpoint=endpoint,
     api_key=subscription_key,
+    http_client=http_client,
 )
 
 # CosmosDB settings
@@ -37,37 +50,67 @@ COSMOS_CONNECTION_STRING = os.getenv("COSMOS_CONNECTION_STRING")
 COSMOS_DATABASE = os.getenv("CONFIGURATION__AZURECOSMOSDB__DATABASENAME", "cosmicworks")
 COSMOS_CONTAINER = os.getenv("CONFIGURATION__AZURECOSMOSDB__CONTAINERNAME", "products")
 
-def query_cosmosdb(sql_query, max_items=10):
+# Roles accepted from the client-supplied conversation history; anything else
+# (e.g. "system" or "tool") is dropped rather than forwarded to the model
+HISTORY_ROLES = frozenset({"user", "assistant"})
+
+# LRU cache of tool results keyed by (function name, canonical JSON of the arguments).
+# The parts catalog only changes when the scraper data is re-uploaded, so identical
+# tool calls from different users can share a result.
+TOOL_CACHE_SIZE = int(os.getenv("TOOL_CACHE_SIZE", 1024))
+_TOOL_CACHE = OrderedDict()
+_TOOL_CACHE_STATS = {"hits": 0, "misses": 0}
+_TOOL_CACHE_LOCK = threading.Lock()
+
+def _get_cached_tool_result(cache_key):
+    """Return the cached tool result for cache_key, or None on a miss."""
+    with _TOOL_CACHE_LOCK:
+        result = _TOOL_CACHE.get(cache_key)
+        if result is None:
+            _TOOL_CACHE_STATS["misses"] += 1
+        else:
+            _TOOL_CACHE.move_to_end(cache_key)
+            _TOOL_CACHE_STATS["hits"] += 1
+        return result
+
+def _cache_tool_result(cache_key, result):
+    """Store a tool result, evicting the least recently used entries above TOOL_CACHE_SIZE."""
+    with _TOOL_CACHE_LOCK:
+        _TOOL_CACHE[cache_key] = result
+        _TOOL_CACHE.move_to_end(cache_key)
+        while len(_TOOL_CACHE) > TOOL_CACHE_SIZE:
+            _TOOL_CACHE.popitem(last=False)
+
+def query_cosmosdb(sql_query, max_items=10, parameters=None):
     """
     Execute a SQL SELECT query against CosmosDB and return the results.
     
     Args:
         sql_query (str): SQL query to execute
         max_items (int): Maximum number of items to return
+        parameters (list): Query parameters, e.g. [{"name": "@brand", "value": "Whirlpool"}]
         
     Returns:
-        str: JSON string of query results
+        list: Query results, or a dict with an "error" key if the query failed
     """
     try:
-        cosmos_client = CosmosClient.from_connection_string(COSMOS_CONNECTION_STRING)
-        database = cosmos_client.get_database_client(COSMOS_DATABASE)
-        container = database.get_container_client(COSMOS_CONTAINER)
+        container = get_container(COSMOS_CONTAINER)
 
         # Only allow SELECT queries for safety
         if not sql_query.strip().lower().startswith("select"):
-            return json.dumps({"error": "Only SELECT queries are allowed."})
+            return {"error": "Only SELECT queries are allowed."}
 
-        items = list(container.query_items(
+        return list(container.query_items(
             query=sql_query,
+            parameters=parameters,
             enable_cross_partition_query=True,
             max_item_count=max_items
         ))
-        return json.dumps(items, indent=2)
     
     except AzureError as ae:
-        return json.dumps({"error": f"Azure Cosmos DB error: {str(ae)}. Original query: {sql_query}"})
+        return {"error": f"Azure Cosmos DB error: {str(ae)}. Original query: {sql_query}"}
     except Exception as e:
-        return json.dumps({"error": f"Error querying database: {str(e)}.  Original query: {sql_query}"})
+        return {"error": f"Error querying database: {str(e)}.  Original query: {sql_query}"}
 
 def find_by_symptom(symptom, max_items=10):
     """
@@ -78,10 +121,10 @@ def find_by_symptom(symptom, max_items=10):
         max_items (int): Maximum number of items to return
         
     Returns:
-        str: JSON string of query results
+        list: Query results, or a dict with an "error" key if the query failed
     """
     # Construct the query to search by symptom - updated for flattened structure
-    sql_query = f"""
+    sql_query = """
     SELECT p.brand_product, 
         item.name,
         item.url,
@@ -99,10 +142,10 @@ def find_by_symptom(symptom, max_items=10):
         item.video_url
     FROM products p
     JOIN item IN p.parts
-    WHERE IS_DEFINED(item.symptoms_fixed) AND CONTAINS(item.symptoms_fixed, '{symptom}')
+    WHERE IS_DEFINED(item.symptoms_fixed) AND CONTAINS(item.symptoms_fixed, @symptom)
     """
     
-    return query_cosmosdb(sql_query, max_items)
+    return query_cosmosdb(sql_query, max_items, [{"name": "@symptom", "value": symptom}])
 
 def find_by_replacement_number(replacement_number, max_items=10):
     """
@@ -113,10 +156,10 @@ def find_by_replacement_number(replacement_number, max_items=10):
         max_items (int): Maximum number of items to return
         
     Returns:
-        str: JSON string of query results
+        list: Query results, or a dict with an "error" key if the query failed
     """
     # Updated for flattened structure
-    sql_query = f"""
+    sql_query = """
     SELECT p.brand_product, 
         item.name,
         item.url,
@@ -134,19 +177,18 @@ def find_by_replacement_number(replacement_number, max_items=10):
         item.video_url
     FROM products p
     JOIN item IN p.parts
-    WHERE IS_DEFINED(item.also_replaces) AND ARRAY_CONTAINS(item.also_replaces, '{replacement_number}')
+    WHERE IS_DEFINED(item.also_replaces) AND ARRAY_CONTAINS(item.also_replaces, @replacement_number)
     """
     
-    results = query_cosmosdb(sql_query, max_items)
-    parsed_results = json.loads(results)
+    results = query_cosmosdb(sql_query, max_items, [{"name": "@replacement_number", "value": replacement_number}])
     
     # If no results found, check if the replacement_number matches the manufacturer_number
-    if not parsed_results or (isinstance(parsed_results, list) and len(parsed_results) == 0):
+    if not results:
         try:
             manufacturer_results = find_by_manufacturer_number(replacement_number, max_items)
             return manufacturer_results
         except Exception as e:
-            return json.dumps({"error": f"Error in fallback search: {str(e)}", "original_results": parsed_results})
+            return {"error": f"Error in fallback search: {str(e)}", "original_results": results}
     
     return results
 
@@ -159,10 +201,10 @@ def find_by_brand_product(brand_product, max_items=10):
         max_items (int): Maximum number of items to return
         
     Returns:
-        str: JSON string of query results
+        list: Query results, or a dict with an "error" key if the query failed
     """
     # Updated for flattened structure
-    sql_query = f"""
+    sql_query = """
     SELECT p.brand_product, 
         item.name,
         item.url,
@@ -180,14 +222,13 @@ def find_by_brand_product(brand_product, max_items=10):
         item.video_url
     FROM products p
     JOIN item IN p.parts
-    WHERE p.brand_product LIKE '{brand_product}%'
+    WHERE p.brand_product LIKE @brand_product_pattern
     """
     
-    results = query_cosmosdb(sql_query, max_items)
-    parsed_results = json.loads(results)
+    results = query_cosmosdb(sql_query, max_items, [{"name": "@brand_product_pattern", "value": f"{brand_product}%"}])
     
     # If no results found, try to split and search by brand and product separately
-    if not parsed_results or (isinstance(parsed_results, list) and len(parsed_results) == 0):
+    if not results:
         try:
             # Try to split the brand_product into brand and product
             parts = brand_product.split('-', 1)
@@ -198,9 +239,9 @@ def find_by_brand_product(brand_product, max_items=10):
                 return brand_results
             else:
                 # If can't split, just return empty results
-                return json.dumps([])
+                return []
         except Exception as e:
-            return json.dumps({"error": f"Error in fallback search: {str(e)}", "original_results": parsed_results})
+            return {"error": f"Error in fallback search: {str(e)}", "original_results": results}
     
     return results
 
@@ -213,10 +254,10 @@ def find_by_brand(brand, max_items=10):
         max_items (int): Maximum number of items to return
         
     Returns:
-        str: JSON string of query results
+        list: Query results, or a dict with an "error" key if the query failed
     """
     # Updated for flattened structure
-    sql_query = f"""
+    sql_query = """
     SELECT p.brand_product, 
         item.name,
         item.url,
@@ -234,10 +275,10 @@ def find_by_brand(brand, max_items=10):
         item.video_url
     FROM products p
     JOIN item IN p.parts
-    WHERE STARTSWITH(p.brand_product, '{brand}')
+    WHERE STARTSWITH(p.brand_product, @brand)
     """
     
-    return query_cosmosdb(sql_query, max_items)
+    return query_cosmosdb(sql_query, max_items, [{"name": "@brand", "value": brand}])
 
 def find_by_product(product, max_items=10):
     """
@@ -248,10 +289,10 @@ def find_by_product(product, max_items=10):
         max_items (int): Maximum number of items to return
         
     Returns:
-        str: JSON string of query results
+        list: Query results, or a dict with an "error" key if the query failed
     """
     # Updated for flattened structure
-    sql_query = f"""
+    sql_query = """
     SELECT p.brand_product, 
         item.name,
         item.url,
@@ -269,10 +310,10 @@ def find_by_product(product, max_items=10):
         item.video_url
     FROM products p
     JOIN item IN p.parts
-    WHERE CONTAINS(p.brand_product, '{product}')
+    WHERE CONTAINS(p.brand_product, @product)
     """
     
-    return query_cosmosdb(sql_query, max_items)
+    return query_cosmosdb(sql_query, max_items, [{"name": "@product", "value": product}])
 
 def find_by_description(description, max_items=10):
     """
@@ -283,10 +324,10 @@ def find_by_description(description, max_items=10):
         max_items (int): Maximum number of items to return
         
     Returns:
-        str: JSON string of query results
+        list: Query results, or a dict with an "error" key if the query failed
     """
     # Updated for flattened structure
-    sql_query = f"""
+    sql_query = """
     SELECT p.brand_product, 
         item.name,
         item.url,
@@ -304,14 +345,13 @@ def find_by_description(description, max_items=10):
         item.video_url
     FROM products p
     JOIN item IN p.parts
-    WHERE CONTAINS(item.description, '{description}') OR CONTAINS(item.name, '{description}')
+    WHERE CONTAINS(item.description, @description) OR CONTAINS(item.name, @description)
     """
     
-    results = query_cosmosdb(sql_query, max_items)
-    parsed_results = json.loads(results)
+    results = query_cosmosdb(sql_query, max_items, [{"name": "@description", "value": description}])
     
     # If no results found, try a more relaxed search
-    if not parsed_results or (isinstance(parsed_results, list) and len(parsed_results) == 0):
+    if not results:
         try:
             # Try to split the description into words and search for parts matching any of the key terms
             words = description.split()
@@ -320,7 +360,8 @@ def find_by_description(description, max_items=10):
                 key_terms = [word for word in words if len(word) > 3]
                 
                 # Build a query that searches for any of these terms
-                search_conditions = " OR ".join([f"CONTAINS(item.name, '{term}')" for term in key_terms])
+                search_conditions = " OR ".join([f"CONTAINS(item.name, @term{i})" for i in range(len(key_terms))])
+                parameters = [{"name": f"@term{i}", "value": term} for i, term in enumerate(key_terms)]
                 
                 fallback_query = f"""
                 SELECT p.brand_product, 
@@ -343,9 +384,9 @@ def find_by_description(description, max_items=10):
                 WHERE {search_conditions}
                 """
                 
-                return query_cosmosdb(fallback_query, max_items)
+                return query_cosmosdb(fallback_query, max_items, parameters)
         except Exception as e:
-            return json.dumps({"error": f"Error in fallback search: {str(e)}", "original_results": parsed_results})
+            return {"error": f"Error in fallback search: {str(e)}", "original_results": results}
     
     return results
 
@@ -358,10 +399,10 @@ def find_by_manufacturer_number(manufacturer_number, max_items=10):
         max_items (int): Maximum number of items to return
         
     Returns:
-        str: JSON string of query results
+        list: Query results, or a dict with an "error" key if the query failed
     """
     # Updated for flattened structure
-    sql_query = f"""
+    sql_query = """
     SELECT p.brand_product, 
         item.name,
         item.url,
@@ -379,10 +420,10 @@ def find_by_manufacturer_number(manufacturer_number, max_items=10):
         item.video_url
     FROM products p
     JOIN item IN p.parts
-    WHERE item.manufacturer_number = '{manufacturer_number}'
+    WHERE item.manufacturer_number = @manufacturer_number
     """
 
-    return query_cosmosdb(sql_query, max_items)
+    return query_cosmosdb(sql_query, max_items, [{"name": "@manufacturer_number", "value": manufacturer_number}])
 
 def find_by_partselect_number(partselect_number, max_items=10):
     """
@@ -393,10 +434,10 @@ def find_by_partselect_number(partselect_number, max_items=10):
         max_items (int): Maximum number of items to return
         
     Returns:
-        str: JSON string of query results
+        list: Query results, or a dict with an "error" key if the query failed
     """
     # Updated for flattened structure
-    sql_query = f"""
+    sql_query = """
     SELECT p.brand_product, 
         item.name,
         item.url,
@@ -414,10 +455,10 @@ def find_by_partselect_number(partselect_number, max_items=10):
         item.video_url
     FROM products p
     JOIN item IN p.parts
-    WHERE item.partselect_number = '{partselect_number}'
+    WHERE item.partselect_number = @partselect_number
     """
     
-    return query_cosmosdb(sql_query, max_items)
+    return query_cosmosdb(sql_query, max_items, [{"name": "@partselect_number", "value": partselect_number}])
 
 # def find_by_any_part_number(part_number, max_items=10):
 #     """
@@ -486,15 +527,13 @@ def find_by_any_part_number(part_number, max_items=10):
         max_items (int): Maximum number of items to return
         
     Returns:
-        str: JSON string of query results
+        list: Query results, or a dict with an "error" key if the query failed
     """
     # First try to find by manufacturer number
-    manufacturer_results = find_by_manufacturer_number(part_number, max_items)
-    manufacturer_items = json.loads(manufacturer_results)
+    manufacturer_items = find_by_manufacturer_number(part_number, max_items)
     
     # Then try to find by PartSelect number
-    partselect_results = find_by_partselect_number(part_number, max_items)
-    partselect_items = json.loads(partselect_results)
+    partselect_items = find_by_partselect_number(part_number, max_items)
     
     # Combine the results, removing duplicates
     combined_results = []
@@ -523,8 +562,7 @@ def find_by_any_part_number(part_number, max_items=10):
     # Try finding replacement parts if direct match not found
     if not combined_results:
         try:
-            replacement_results = find_by_replacement_number(part_number, max_items)
-            replacement_items = json.loads(replacement_results)
+            replacement_items = find_by_replacement_number(part_number, max_items)
             
             if isinstance(replacement_items, list):
                 for item in replacement_items:
@@ -548,7 +586,7 @@ def find_by_any_part_number(part_number, max_items=10):
             # Log the error but continue
             print(f"Error finding replacement parts: {str(e)}")
     
-    return json.dumps(combined_results[:max_items])
+    return combined_results[:max_items]
 
 # def query_azure_openai(user_query, writeOutput=print):
 #     """
@@ -905,6 +943,39 @@ def find_by_any_part_number(part_number, max_items=10):
 #         writeOutput(error_message, isCode=True)
 #         return {"error": error_message}
     
+# Instructions sent before the final call so the frontend can render the parts found
+FORMATTING_INSTRUCTIONS = """
+You should now explain the results to the user. 
+- If multiple search results come up, it is likely that the same part is used for multiple appliances. 
+- If the user asked about installation help, make sure to include any video_url in your response and in the dictionary.
+- If there were alternative parts found, be sure to mention them.
+
+If you are very certain about the result(s), you should format the result as a list of dictionaries. Even if there is only one result you should format it as a list of length 1.
+The users will not know it is a list of dictionaries. 
+
+IMPORTANT: Always include the image_url and video_url fields in your dictionary output, even if they are empty strings.
+
+Make sure you include ```dictionary-list-to-render as the frontend will render this list of dictionaries nicely in the UI.\n"
+Example:
+```dictionary-list-to-render
+[
+    {
+    "part_name": "Dacor Refrigerator Part",
+    "manufacturer_number": "123456",
+    "partselect_number": "PS1990907",
+    "price": "$99.99",
+    "stock_status": "In Stock",
+    "rating": 4.5,
+    "reviews_count": 10,
+    "url": "https://www.partselect.com/Parts/123456",
+    "image_url": "https://www.partselect.com/Images/123456.jpg",
+    "video_url": "https://www.youtube.com/watch?v=abcdef"
+    },
+    ...
+]
+```
+"""
+
 # Add this new function to handle conversation history
 def query_azure_openai_with_history(user_query, conversation_history, writeOutput=print):
     """
@@ -918,6 +989,31 @@ def query_azure_openai_with_history(user_query, conversation_history, writeOutpu
     Returns:
         str: Response from Azure OpenAI
     """
+    try:
+        return "".join(stream_azure_openai_with_history(user_query, conversation_history, writeOutput))
+    except AzureError as ae:
+        error_message = f"Azure OpenAI error: {str(ae)}"
+        writeOutput(error_message, isCode=True)
+        return {"error": error_message}
+    except Exception as e:
+        error_message = f"Error calling Azure OpenAI: {str(e)}"
+        writeOutput(error_message, isCode=True)
+        return {"error": error_message}
+
+def stream_azure_openai_with_history(user_query, conversation_history, writeOutput=print):
+    """
+    Same as query_azure_openai_with_history, but yields the response while it is generated.
+    The first call (tool selection) is not streamed since the tool calls must be complete
+    before they can be run; the final answer is streamed chunk by chunk.
+    
+    Args:
+        user_query (str): The current user query
+        conversation_history (list): List of previous messages in the conversation
+        writeOutput (function): Function to handle output messages
+        
+    Yields:
+        str: Chunks of the response from Azure OpenAI
+    """
     tools = [
         {
             "type": "function",
@@ -1121,12 +1217,11 @@ def query_azure_openai_with_history(user_query, conversation_history, writeOutpu
     # Add conversation history
     if conversation_history:
         writeOutput(f"Adding {len(conversation_history)} previous messages as context")
-        for msg in conversation_history:
-            if msg.get("role") and msg.get("content"):
-                messages.append({
-                    "role": msg["role"],
-                    "content": msg["content"]
-                })
+        messages.extend(
+            {"role": role, "content": content}
+            for msg in conversation_history
+            if (role := msg.get("role")) in HISTORY_ROLES and (content := msg.get("content"))
+        )
     
     # Add the current user query
     messages.append({
@@ -1134,149 +1229,154 @@ def query_azure_openai_with_history(user_query, conversation_history, writeOutpu
         "content": user_query,
     })
 
+    if http_client.is_closed:
+        writeOutput("Warning: the shared Azure OpenAI HTTP client has been closed", isCode=True)
+
     writeOutput("Sending request to Azure OpenAI with conversation history...", isCode=True)
 
-    try:
-        # First call: let the model decide if it wants to use the tool
-        response = client.chat.completions.create(
-            messages=messages,
-            max_completion_tokens=2000,
-            temperature=0.7,
-            top_p=0.95,
-            frequency_penalty=0.0,
-            presence_penalty=0.0,
-            model=deployment,
-            tools=tools,
-            tool_choice="auto"
-        )
+    # First call: let the model decide if it wants to use the tool
+    response = client.chat.completions.create(
+        messages=messages,
+        max_completion_tokens=2000,
+        temperature=0.7,
+        top_p=0.95,
+        frequency_penalty=0.0,
+        presence_penalty=0.0,
+        model=deployment,
+        tools=tools,
+        tool_choice="auto"
+    )
 
-        response_message = response.choices[0].message
-        messages.append(response_message)
+    response_message = response.choices[0].message
+    messages.append(response_message)
 
-        writeOutput(f"AI Response: {response_message.content}", isCode=True)
-        
-        # If the model called a tool, execute it and append the result
-        if getattr(response_message, "tool_calls", None):
-            writeOutput("AI is searching for parts...", isCode=True)
-            for tool_call in response_message.tool_calls:
-                args = json.loads(tool_call.function.arguments)
-                
-                if tool_call.function.name == "find_by_brand_product":
-                    brand_product = args.get("brand_product")
-                    max_items = args.get("max_items", 10)
-                    writeOutput(f"Searching for brand/product: {brand_product}", isCode=True)
-                    tool_result = find_by_brand_product(brand_product, max_items)
-                
-                elif tool_call.function.name == "find_by_brand":
-                    brand = args.get("brand")
-                    max_items = args.get("max_items", 10)
-                    writeOutput(f"Searching for brand: {brand}", isCode=True)
-                    tool_result = find_by_brand(brand, max_items)
-                
-                elif tool_call.function.name == "find_by_product":
-                    product = args.get("product")
-                    max_items = args.get("max_items", 10)
-                    writeOutput(f"Searching for product: {product}", isCode=True)
-                    tool_result = find_by_product(product, max_items)
-                
-                elif tool_call.function.name == "find_by_any_part_number":
-                    part_number = args.get("part_number")
-                    max_items = args.get("max_items", 10)
-                    writeOutput(f"Searching by part number: {part_number}", isCode=True)
-                    tool_result = find_by_any_part_number(part_number, max_items)
+    writeOutput(f"AI Response: {response_message.content}", isCode=True)
+    
+    # If the model called a tool, execute it and append the result
+    if getattr(response_message, "tool_calls", None):
+        writeOutput("AI is searching for parts...", isCode=True)
+        tool_results = []
+        for tool_call in response_message.tool_calls:
+            args = orjson.loads(tool_call.function.arguments)
+            cache_key = (tool_call.function.name, orjson.dumps(args, option=orjson.OPT_SORT_KEYS))
+            tool_result = _get_cached_tool_result(cache_key)
+            cached = tool_result is not None
+            
+            if cached:
+                writeOutput(f"Using cached result for {tool_call.function.name}", isCode=True)
+
+            elif tool_call.function.name == "find_by_brand_product":
+                brand_product = args.get("brand_product")
+                max_items = args.get("max_items", 10)
+                writeOutput(f"Searching for brand/product: {brand_product}", isCode=True)
+                tool_result = find_by_brand_product(brand_product, max_items)
+            
+            elif tool_call.function.name == "find_by_brand":
+                brand = args.get("brand")
+                max_items = args.get("max_items", 10)
+                writeOutput(f"Searching for brand: {brand}", isCode=True)
+                tool_result = find_by_brand(brand, max_items)
+            
+            elif tool_call.function.name == "find_by_product":
+                product = args.get("product")
+                max_items = args.get("max_items", 10)
+                writeOutput(f"Searching for product: {product}", isCode=True)
+                tool_result = find_by_product(product, max_items)
+            
+            elif tool_call.function.name == "find_by_any_part_number":
+                part_number = args.get("part_number")
+                max_items = args.get("max_items", 10)
+                writeOutput(f"Searching by part number: {part_number}", isCode=True)
+                tool_result = find_by_any_part_number(part_number, max_items)
+
+            elif tool_call.function.name == "find_by_description":
+                description = args.get("description")
+                max_items = args.get("max_items", 10)
+                writeOutput(f"Searching for description: {description}", isCode=True)
+                tool_result = find_by_description(description, max_items)
+            elif tool_call.function.name == "find_by_symptom":
+                symptom = args.get("symptom")
+                max_items = args.get("max_items", 10)
+                writeOutput(f"Searching for parts that fix symptom: {symptom}", isCode=True)
+                tool_result = find_by_symptom(symptom, max_items)
+
+            elif tool_call.function.name == "find_by_replacement_number":
+                replacement_number = args.get("replacement_number")
+                max_items = args.get("max_items", 10)
+                writeOutput(f"Searching for parts that can replace: {replacement_number}", isCode=True)
+                tool_result = find_by_replacement_number(replacement_number, max_items)
 
-                elif tool_call.function.name == "find_by_description":
-                    description = args.get("description")
-                    max_items = args.get("max_items", 10)
-                    writeOutput(f"Searching for description: {description}", isCode=True)
-                    tool_result = find_by_description(description, max_items)
-                elif tool_call.function.name == "find_by_symptom":
-                    symptom = args.get("symptom")
-                    max_items = args.get("max_items", 10)
-                    writeOutput(f"Searching for parts that fix symptom: {symptom}", isCode=True)
-                    tool_result = find_by_symptom(symptom, max_items)
+            # Don't cache errors so that transient database failures are retried
+            if not cached and not (isinstance(tool_result, dict) and "error" in tool_result):
+                _cache_tool_result(cache_key, tool_result)
 
-                elif tool_call.function.name == "find_by_replacement_number":
-                    replacement_number = args.get("replacement_number")
-                    max_items = args.get("max_items", 10)
-                    writeOutput(f"Searching for parts that can replace: {replacement_number}", isCode=True)
-                    tool_result = find_by_replacement_number(replacement_number, max_items)
-                messages.append({
-                    "tool_call_id": tool_call.id,
-                    "role": "tool",
-                    "name": tool_call.function.name,
-                    "content": tool_result,
-                })
+            tool_results.append((tool_call, tool_result))
 
+        hits, misses = _TOOL_CACHE_STATS["hits"], _TOOL_CACHE_STATS["misses"]
+        writeOutput(f"Tool cache hit rate: {hits}/{hits + misses}", isCode=True)
+
+        # Different tools often return the same part (e.g. brand/product and replacement
+        # searches), so only pass each partselect_number to the model once
+        seen_parts = set()
+        found = 0
+        for tool_call, tool_result in tool_results:
             # Check if we got valid results or an error
-            results = json.loads(messages[-1]["content"])
-            if isinstance(results, dict) and "error" in results:
-                writeOutput(f"Search error: {results['error']}", isCode=True)
-            else:
-                writeOutput(f"Found {len(results) if isinstance(results, list) else 0} results", isCode=True)
+            if isinstance(tool_result, dict) and "error" in tool_result:
+                writeOutput(f"Search error: {tool_result['error']}", isCode=True)
+            elif isinstance(tool_result, list):
+                unique_items = []
+                for item in tool_result:
+                    partselect_number = item.get("partselect_number")
+                    if partselect_number in seen_parts:
+                        continue
+                    if partselect_number:
+                        seen_parts.add(partselect_number)
+                    unique_items.append(item)
+                tool_result = unique_items
+                found += len(tool_result)
 
+            # The tools return native objects; only the message sent to the model needs JSON
             messages.append({
-                "role": "user",
-                "content": (
-                    """
-                    You should now explain the results to the user. 
-                    - If multiple search results come up, it is likely that the same part is used for multiple appliances. 
-                    - If the user asked about installation help, make sure to include any video_url in your response and in the dictionary.
-                    - If there were alternative parts found, be sure to mention them.
-                    
-                    If you are very certain about the result(s), you should format the result as a list of dictionaries. Even if there is only one result you should format it as a list of length 1.
-                    The users will not know it is a list of dictionaries. 
-                    
-                    IMPORTANT: Always include the image_url and video_url fields in your dictionary output, even if they are empty strings.
-                    
-                    Make sure you include ```dictionary-list-to-render as the frontend will render this list of dictionaries nicely in the UI.\n"
-                    Example:
-                    ```dictionary-list-to-render
-                    [
-                        {
-                        "part_name": "Dacor Refrigerator Part",
-                        "manufacturer_number": "123456",
-                        "partselect_number": "PS1990907",
-                        "price": "$99.99",
-                        "stock_status": "In Stock",
-                        "rating": 4.5,
-                        "reviews_count": 10,
-                        "url": "https://www.partselect.com/Parts/123456",
-                        "image_url": "https://www.partselect.com/Images/123456.jpg",
-                        "video_url": "https://www.youtube.com/watch?v=abcdef"
-                        },
-                        ...
-                    ]
-                    ```
-                    """
-                )
+                "tool_call_id": tool_call.id,
+                "role": "tool",
+                "name": tool_call.function.name,
+                "content": orjson.dumps(tool_result).decode(),
             })
-            # Second call: get the final answer from the model
-            writeOutput("Getting final response from Azure OpenAI to show to user", isCode=True)
-            final_response = client.chat.completions.create(
-                messages=messages,
-                max_completion_tokens=2000,
-                temperature=0.7,
-                top_p=0.95,
-                frequency_penalty=0.0,
-                presence_penalty=0.0,
-                model=deployment
-            )
-            writeOutput("Final response received from Azure OpenAI.", isCode=True)
-            writeOutput(f"{final_response.choices[0].message.content}", isCode=True)
-            return final_response.choices[0].message.content
-        else:
-            # No tool call, just return the model's direct response
-            return response_message.content
-    
-    except AzureError as ae:
-        error_message = f"Azure OpenAI error: {str(ae)}"
-        writeOutput(error_message, isCode=True)
-        return {"error": error_message}
-    except Exception as e:
-        error_message = f"Error calling Azure OpenAI: {str(e)}"
-        writeOutput(error_message, isCode=True)
-        return {"error": error_message}
+
+        writeOutput(f"Found {found} results", isCode=True)
+
+        messages.append({
+            "role": "user",
+            "content": FORMATTING_INSTRUCTIONS
+        })
+        # Second call: get the final answer from the model
+        writeOutput("Getting final response from Azure OpenAI to show to user", isCode=True)
+        final_content = []
+        # The with block closes the response, returning its connection to the pool,
+        # even when the client disconnects and the generator is closed early
+        with client.chat.completions.create(
+            messages=messages,
+            max_completion_tokens=2000,
+            temperature=0.7,
+            top_p=0.95,
+            frequency_penalty=0.0,
+            presence_penalty=0.0,
+            model=deployment,
+            stream=True
+        ) as final_response:
+            for chunk in final_response:
+                # Azure sends some chunks without choices (e.g. content filter results)
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    final_content.append(content)
+                    yield content
+        writeOutput("Final response received from Azure OpenAI.", isCode=True)
+        writeOutput("".join(final_content), isCode=True)
+    else:
+        # No tool call, just return the model's direct response
+        yield response_message.content or ""
 
 # Example usage
 if __name__ == "__main__":
@@ -1,28 +1,262 @@
 from dotenv import load_dotenv
 
-from azure.cosmos import CosmosClient
+from azure.cosmos import CosmosClient, PartitionKey
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosHttpResponseError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+from azure.cosmos.partition_key import NonePartitionKeyValue
+from azure.core import MatchConditions
 from azure.identity import DefaultAzureCredential
 
-import json
+import asyncio
+import functools
+import hashlib
+import orjson
 import os
 import glob
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
 load_dotenv()
 
+COSMOS_DATABASE = os.getenv("CONFIGURATION__AZURECOSMOSDB__DATABASENAME", "cosmicworks")
+COSMOS_CONTAINER = os.getenv("CONFIGURATION__AZURECOSMOSDB__CONTAINERNAME", "products")
+
+# Lookup containers holding one document per part, partitioned (and keyed) by the
+# part number, so a part can be fetched with a point read instead of a cross-partition
+# scan over every catalog's parts array
+PART_BY_PS_CONTAINER = os.getenv("COSMOS_PART_BY_PS_CONTAINER", "part_by_ps")
+PART_BY_MN_CONTAINER = os.getenv("COSMOS_PART_BY_MN_CONTAINER", "part_by_mn")
+LOOKUP_CONTAINERS = {
+    "partselect_number": PART_BY_PS_CONTAINER,
+    "manufacturer_number": PART_BY_MN_CONTAINER,
+}
+# Item-level part fields copied into each lookup container's documents: those the
+# find_* function reading it returns, the same fields its fallback query projects
+LOOKUP_FIELDS = {
+    "partselect_number": (
+        "name", "url", "image_url", "description", "partselect_number", "manufacturer_number",
+        "price", "stock_status", "reviews_count", "rating", "symptoms_fixed", "works_with",
+        "also_replaces", "video_url"
+    ),
+    "manufacturer_number": ("name", "reviews_count", "reviews"),
+}
+# Characters Cosmos DB does not allow in a document id
+INVALID_ID_CHARACTERS = frozenset("/\\?#")
+
+# Cosmos DB indexes every path by default, including the large details/reviews
+# blobs nothing filters on. Only the paths used in WHERE clauses are indexed,
+# including the name, description and symptom filters of the agent's searches;
+# symptoms_fixed is indexed both as a string and as an array of strings.
+PRODUCTS_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "includedPaths": [
+        {"path": "/type/?"},
+        {"path": "/brand_product/?"},
+        {"path": "/parts/[]/partselect_number/?"},
+        {"path": "/parts/[]/manufacturer_number/?"},
+        {"path": "/parts/[]/also_replaces/[]/?"},
+        {"path": "/parts/[]/name/?"},
+        {"path": "/parts/[]/description/?"},
+        {"path": "/parts/[]/symptoms_fixed/?"},
+        {"path": "/parts/[]/symptoms_fixed/[]/?"}
+    ],
+    "excludedPaths": [{"path": "/*"}]
+}
+# Lookup documents are point read; the only query finds those a catalog owns
+LOOKUP_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "includedPaths": [{"path": "/brand_product/?"}],
+    "excludedPaths": [{"path": "/*"}]
+}
+
+# Number of upserts in flight at once when uploading, and how many times a
+# throttled (429) upsert is retried before the file is reported as failed
+UPLOAD_CONCURRENCY = int(os.getenv("COSMOS_UPLOAD_CONCURRENCY", 50))
+UPLOAD_MAX_RETRIES = 5
+
+# Threads reading and parsing catalog files, and how many parsed documents may
+# wait for an upload worker before the parsers pause
+PARSE_WORKERS = 4
+UPLOAD_QUEUE_SIZE = 32
+
+# Each catalog document stores a hash of its source file, so files that have not
+# changed since the last upload can be skipped without re-parsing or re-writing them.
+# The partition key value is read too, so chunks left over from an earlier, larger
+# version of a file can be deleted; {partition_key} is filled in with its path.
+CATALOG_DOCUMENTS_QUERY = "SELECT c.id, c.brand_product, c.content_hash, c{partition_key} AS partition_key FROM c WHERE c.type = 'parts_catalog'"
+# Lookup documents owned by a catalog, so those for parts it no longer lists can be
+# deleted. The etag makes the delete fail if another catalog took the part over meanwhile.
+CATALOG_LOOKUPS_QUERY = "SELECT c.id, c._etag FROM c WHERE c.brand_product = @brand_product"
+
+# Catalog files larger than this are parsed incrementally (when ijson is installed)
+# and split into documents of at most PARTS_PER_DOCUMENT parts each
+STREAM_PARSE_THRESHOLD = 4 * 1024 * 1024
+PARTS_PER_DOCUMENT = 500
+
+# Query text is kept constant and values are passed as parameters, so the SDK and
+# the gateway see identical text on every call and can reuse the query plan
+# SELECT VALUE returns the projected objects directly instead of wrapping each
+# row, and STARTSWITH can be served from the brand_product range index
+PARTS_BY_BRAND_PRODUCT_QUERY = """
+SELECT VALUE {"name": item.name, "manufacturer_number": item.manufacturer_number, "price": item.price}
+FROM products p
+JOIN item IN p.parts
+WHERE STARTSWITH(p.brand_product, @brand_product_prefix)
+"""
+
+# Lookups by part number only ever use the first match, so TOP 1 lets the query
+# engine stop at the first hit instead of scanning every partition for more
+PART_BY_PARTSELECT_NUMBER_QUERY = """
+SELECT TOP 1 p.brand_product, 
+    item.name,
+    item.url,
+    item.image_url,
+    item.description,
+    item.partselect_number,
+    item.manufacturer_number,
+    item.price,
+    item.stock_status,
+    item.reviews_count,
+    item.rating,
+    item.symptoms_fixed,
+    item.works_with,
+    item.also_replaces,
+    item.video_url
+FROM products p
+JOIN item IN p.parts
+WHERE item.partselect_number = @partselect_number
+"""
+
+PART_REVIEWS_BY_MANUFACTURER_NUMBER_QUERY = """
+SELECT TOP 1 p.brand_product, 
+       item.name, 
+       item.reviews_count,
+       item.reviews
+FROM products p
+JOIN item IN p.parts
+WHERE item.manufacturer_number = @manufacturer_number
+"""
+
+@functools.lru_cache(maxsize=1)
+def get_cosmos_client():
+    """
+    Return the process-wide CosmosClient. Building a client fetches account metadata
+    and opens a new connection pool, so it is created once and shared by every caller.
+    """
+    return CosmosClient.from_connection_string(os.getenv("COSMOS_CONNECTION_STRING"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_database():
+    """Return the shared database client."""
+    return get_cosmos_client().get_database_client(COSMOS_DATABASE)
+
+
+@functools.lru_cache(maxsize=None)
+def get_container(container_name=COSMOS_CONTAINER):
+    """Return the shared container client for container_name."""
+    return get_database().get_container_client(container_name)
+
+
 def getLastRequestCharge(c):
     return c.client_connection.last_response_headers["x-ms-request-charge"]
 
 
-def upload_json_files_to_cosmos(container, data_dir, writeOutput=print):
+def ensure_products_indexing_policy(database, container):
+    """
+    Apply PRODUCTS_INDEXING_POLICY to the products container if it is not already
+    in place. Changing the policy triggers a background re-index, so it is skipped
+    when the included paths already match. replace_container resets any property it
+    is not given, so the container's other settings are passed through unchanged.
+    """
+    properties = container.read()
+    included = {p["path"] for p in properties.get("indexingPolicy", {}).get("includedPaths", [])}
+    if included == {p["path"] for p in PRODUCTS_INDEXING_POLICY["includedPaths"]}:
+        return
+    
+    partition_key = properties["partitionKey"]
+    kind = partition_key.get("kind", "Hash")
+    database.replace_container(
+        container,
+        partition_key=PartitionKey(
+            path=partition_key["paths"] if kind == "MultiHash" else partition_key["paths"][0],
+            kind=kind,
+            # Containers created with version 1 partition keys report no version
+            version=partition_key.get("version", 1)
+        ),
+        indexing_policy=PRODUCTS_INDEXING_POLICY,
+        default_ttl=properties.get("defaultTtl"),
+        conflict_resolution_policy=properties.get("conflictResolutionPolicy"),
+        analytical_storage_ttl=properties.get("analyticalStorageTtl")
+    )
+
+
+def find_part_by_partselect_number(partselect_number):
+    """
+    Return the part with the given PartSelect number, or None if there is none.
+    Reads the part_by_ps lookup container and falls back to a query for
+    catalogs uploaded before the lookup containers existed.
+    """
+    try:
+        lookup = get_container(PART_BY_PS_CONTAINER).read_item(item=partselect_number, partition_key=partselect_number)
+    except CosmosResourceNotFoundError:
+        return next(iter(get_container().query_items(
+            query=PART_BY_PARTSELECT_NUMBER_QUERY,
+            parameters=[{"name": "@partselect_number", "value": partselect_number}],
+            enable_cross_partition_query=True,
+            max_item_count=1
+        )), None)
+    
+    return {"brand_product": lookup["brand_product"], **lookup["part"]}
+
+
+def find_part_reviews_by_manufacturer_number(manufacturer_number):
     """
-    Upload all JSON files from a directory to CosmosDB
+    Return the name and reviews of the part with the given manufacturer number,
+    or None if there is none. Reads the part_by_mn lookup container and falls
+    back to a query like find_part_by_partselect_number.
+    """
+    try:
+        lookup = get_container(PART_BY_MN_CONTAINER).read_item(item=manufacturer_number, partition_key=manufacturer_number)
+    except CosmosResourceNotFoundError:
+        return next(iter(get_container().query_items(
+            query=PART_REVIEWS_BY_MANUFACTURER_NUMBER_QUERY,
+            parameters=[{"name": "@manufacturer_number", "value": manufacturer_number}],
+            enable_cross_partition_query=True,
+            max_item_count=1
+        )), None)
+    
+    return {"brand_product": lookup["brand_product"], **lookup["part"]}
+
+
+def upload_json_files_to_cosmos(container, data_dir, writeOutput=print, include_ru=False):
+    """
+    Upload all JSON files from a directory to CosmosDB. Files are upserted
+    concurrently through the async SDK.
     
     Args:
-        container: CosmosDB container client
+        container: CosmosDB container client (its id selects the target container)
         data_dir: Directory containing JSON files
         writeOutput: Function to output results
+        include_ru: Whether to report the request charge (RU) of each file in the results
     
     Returns:
         dict: Summary of upload results
@@ -46,64 +280,360 @@ def upload_json_files_to_cosmos(container, data_dir, writeOutput=print):
     stats = {
         "total": len(json_files),
         "uploaded": 0,
+        "skipped": 0,
         "failed": 0,
         "files": []
     }
     
-    for json_file in json_files:
-        file_name = os.path.basename(json_file)
-        brand_product = os.path.splitext(file_name)[0]  # Remove .json extension
-        
+    asyncio.run(_upload_json_files_async(container.id, json_files, stats, writeOutput, include_ru))
+    
+    writeOutput(f"Upload complete. Total: {stats['total']}, Succeeded: {stats['uploaded']}, Unchanged: {stats['skipped']}, Failed: {stats['failed']}")
+    return stats
+
+
+async def _upload_json_files_async(container_name, json_files, stats, writeOutput, include_ru):
+    """
+    Upload json_files through a producer/consumer pipeline: files are read and parsed
+    on a thread pool while UPLOAD_CONCURRENCY workers upsert the resulting documents,
+    so disk reads and parsing overlap with network writes.
+    """
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    parse_slots = asyncio.Semaphore(PARSE_WORKERS)
+    documents = asyncio.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+    async with AsyncCosmosClient.from_connection_string(os.getenv("COSMOS_CONNECTION_STRING")) as client:
+        database = client.get_database_client(COSMOS_DATABASE)
+        container = database.get_container_client(container_name)
+        lookups = {
+            key: await database.create_container_if_not_exists(
+                id=name,
+                partition_key=PartitionKey(path=f"/{key}"),
+                indexing_policy=LOOKUP_INDEXING_POLICY
+            )
+            for key, name in LOOKUP_CONTAINERS.items()
+        }
+        # One query up front instead of a read per file
+        partition_key_path = (await container.read())["partitionKey"]["paths"][0]
+        partition_key = "".join(f'["{segment}"]' for segment in partition_key_path.strip("/").split("/"))
+        catalog = defaultdict(dict)
+        async for item in container.query_items(query=CATALOG_DOCUMENTS_QUERY.format(partition_key=partition_key)):
+            catalog[item.get("brand_product")][item["id"]] = item
+        workers = [
+            asyncio.create_task(_upload_worker(semaphore, container, lookups, documents, include_ru))
+            for _ in range(UPLOAD_CONCURRENCY)
+        ]
         try:
-            # Load JSON content
-            with open(json_file, 'r', encoding='utf-8') as f:
-                parts_data = json.load(f)
+            with ThreadPoolExecutor(max_workers=PARSE_WORKERS) as executor:
+                await asyncio.gather(*[
+                    _upload_json_file(executor, parse_slots, documents, semaphore, container, lookups, catalog, json_file, stats, writeOutput, include_ru)
+                    for json_file in json_files
+                ])
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+
+async def _upload_json_file(executor, parse_slots, documents, semaphore, container, lookups, catalog, json_file, stats, writeOutput, include_ru):
+    """
+    Parse a single JSON file on the executor, queue its parts catalog documents for
+    the upload workers and record the outcome in stats once they are all uploaded.
+    Files whose hash matches the content_hash stored in Cosmos DB are skipped, and
+    the chunks and lookup documents of parts the file no longer has are deleted.
+    
+    The hash is only stored on the first document, which is queued last, once every
+    other chunk is uploaded and the stale documents are deleted. If any of that fails the
+    stored hash still differs, so the file is uploaded again on the next run.
+    """
+    loop = asyncio.get_running_loop()
+    file_name = os.path.basename(json_file)
+    brand_product = os.path.splitext(file_name)[0]  # Remove .json extension
+    
+    document_id = brand_product.replace("-", "_").lower()  # Create a valid ID
+    
+    uploads = []
+    first_document = None
+    # Part numbers the file lists, per lookup container key
+    part_numbers = {key: set() for key in lookups}
+    try:
+        # Only PARSE_WORKERS files are read at once, so files waiting on a full
+        # queue don't each hold a parsed document in memory
+        async with parse_slots:
+            content_hash = await loop.run_in_executor(executor, _hash_file, json_file)
+            existing = catalog[brand_product]
+            if existing.get(document_id, {}).get("content_hash") == content_hash:
+                stats["skipped"] += 1
+                stats["files"].append({"file": file_name, "status": "unchanged", "id": document_id})
+                writeOutput(f"Unchanged: {file_name} -> Document ID: {document_id}")
+                return
             
-            # Prepare document with metadata
-            document = {
-                "id": brand_product.replace("-", "_").lower(),  # Create a valid ID
-                "brand_product": brand_product,
-                "type": "parts_catalog",
-                "parts": parts_data
-            }
+            chunks = _iter_parts_chunks(json_file)
+            while (parts_data := await loop.run_in_executor(executor, next, chunks, None)) is not None:
+                # Prepare document with metadata; extra chunks of a large file get a suffix
+                document = {
+                    "id": document_id if first_document is None else f"{document_id}_{len(uploads) + 1}",
+                    "brand_product": brand_product,
+                    "type": "parts_catalog",
+                    "parts": parts_data
+                }
+                for part in parts_data:
+                    for key, numbers in part_numbers.items():
+                        numbers.add(part.get(key))
+                if first_document is None:
+                    first_document = document
+                    continue
+                uploads.append(await _queue_upload(documents, document))
+        
+        results = await asyncio.gather(*uploads)
+        uploaded_ids = [document_id] + [uploaded_id for uploaded_id, _ in results]
+        
+        # A file that shrank leaves its old trailing chunks behind; their parts would
+        # otherwise keep showing up in queries
+        request_charges = []
+        record_charge = None
+        if include_ru:
+            def record_charge(headers, _):
+                request_charges.append(float(headers.get("x-ms-request-charge", 0)))
+        await asyncio.gather(*[
+            _delete_with_retry(semaphore, container, stale["id"], stale.get("partition_key", NonePartitionKeyValue), record_charge)
+            for stale in existing.values()
+            if stale["id"] not in uploaded_ids
+        ], *[
+            _delete_stale_lookups(semaphore, lookup_container, brand_product, part_numbers[key], record_charge)
+            for key, lookup_container in lookups.items()
+        ])
+        
+        first_document["content_hash"] = content_hash
+        uploads.append(await _queue_upload(documents, first_document))
+        results.append(await uploads[-1])
+        
+        file_info = {
+            "file": file_name, 
+            "status": "success", 
+            "id": ", ".join(uploaded_ids)
+        }
+        if include_ru:
+            file_info["request_charge"] = sum(request_charge for _, request_charge in results) + sum(request_charges)
+        stats["uploaded"] += 1
+        stats["files"].append(file_info)
+        
+        writeOutput(f"Uploaded: {file_name} -> Document ID: {', '.join(uploaded_ids)}")
+        
+    except Exception as e:
+        # Let the chunks already queued settle so none is left unawaited
+        await asyncio.gather(*uploads, return_exceptions=True)
+        stats["failed"] += 1
+        stats["files"].append({"file": file_name, "status": "failed", "error": str(e)})
+        writeOutput(f"Failed to upload {file_name}: {str(e)}")
+
+
+async def _queue_upload(documents, document):
+    """Queue document for the upload workers and return the future they resolve."""
+    uploaded = asyncio.get_running_loop().create_future()
+    await documents.put((document, uploaded))
+    return uploaded
+
+
+async def _upload_worker(semaphore, container, lookups, documents, include_ru):
+    """
+    Index the parts of queued documents in the lookup containers and then upsert the
+    documents until cancelled, resolving each document's future with (id, request charge)
+    or the error. The request charge is None unless include_ru is set.
+    """
+    while True:
+        document, uploaded = await documents.get()
+        # Each upsert reports its own charge through the response hook; the
+        # client's last_response_headers are shared by all concurrent requests
+        request_charges = []
+        record_charge = None
+        if include_ru:
+            def record_charge(headers, _):
+                request_charges.append(float(headers.get("x-ms-request-charge", 0)))
+        try:
+            # Index every part of the document in the lookup containers first, so a
+            # document is only written once its parts can be found
+            await asyncio.gather(*[
+                _upsert_lookup(semaphore, lookup_container, lookup, record_charge)
+                for lookup_container, lookup in _iter_lookup_documents(lookups, document)
+            ])
             
             # Upload to Cosmos DB
-            created_item = container.upsert_item(document)
-            
-            stats["uploaded"] += 1
-            stats["files"].append({
-                "file": file_name, 
-                "status": "success", 
-                "id": created_item["id"],
-                "request_charge": getLastRequestCharge(container)
-            })
-            
-            writeOutput(f"Uploaded: {file_name} -> Document ID: {created_item['id']}")
-            
+            created_item = await _upsert_with_retry(semaphore, container, document, record_charge)
+            uploaded.set_result((created_item["id"], sum(request_charges) if include_ru else None))
         except Exception as e:
-            stats["failed"] += 1
-            stats["files"].append({"file": file_name, "status": "failed", "error": str(e)})
-            writeOutput(f"Failed to upload {file_name}: {str(e)}")
-    
-    writeOutput(f"Upload complete. Total: {stats['total']}, Succeeded: {stats['uploaded']}, Failed: {stats['failed']}")
-    return stats
+            uploaded.set_exception(e)
+        finally:
+            documents.task_done()
 
 
-def runDemo(writeOutput):
-    load_dotenv()
+def _hash_file(json_file):
+    """Return the BLAKE2b hex digest of a file, read in 1 MB blocks."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(json_file, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# simdjson parsers reuse their internal buffers across documents but are not
+# thread safe, so each thread keeps its own
+_parsers = threading.local()
+
+
+def _loads(raw):
+    """Decode JSON bytes with simdjson when it is installed, otherwise with orjson."""
+    if simdjson is None:
+        return orjson.loads(raw)
+    
+    parser = getattr(_parsers, "parser", None)
+    if parser is None:
+        parser = _parsers.parser = simdjson.Parser()
+    # recursive=True converts to plain dicts and lists up front, so the result
+    # stays valid after the parser is reused for the next file
+    return parser.parse(raw, recursive=True)
+
+
+def _iter_parts_chunks(json_file):
+    """
+    Yield the parts list of a catalog file. Files above STREAM_PARSE_THRESHOLD are
+    streamed with ijson and yielded in chunks of PARTS_PER_DOCUMENT, so the whole
+    file is never held in memory; smaller files are loaded in one piece.
+    """
+    if ijson is None or os.path.getsize(json_file) <= STREAM_PARSE_THRESHOLD:
+        with open(json_file, 'rb') as f:
+            yield _loads(f.read())
+        return
+    
+    with open(json_file, 'rb') as f:
+        chunk = []
+        # use_float keeps numbers JSON serializable (ijson yields Decimal by default)
+        for part in ijson.items(f, "item", use_float=True):
+            chunk.append(part)
+            if len(chunk) == PARTS_PER_DOCUMENT:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _iter_lookup_documents(lookups, document):
+    """
+    Yield (lookup container, lookup document) pairs for every part of a catalog
+    document. Parts whose number is missing or not a valid document id are skipped.
+    Each lookup document holds only the part fields read from its container.
+    """
+    for part in document["parts"]:
+        for key, lookup_container in lookups.items():
+            value = part.get(key)
+            if not isinstance(value, str) or not value or INVALID_ID_CHARACTERS.intersection(value):
+                continue
+            yield lookup_container, {
+                "id": value,
+                key: value,
+                "brand_product": document["brand_product"],
+                "ref_id": document["id"],
+                "part": _lookup_part(key, part)
+            }
+
+
+def _lookup_part(key, part):
+    """
+    Return the LOOKUP_FIELDS of part stored in the lookup container for key. Fields the
+    part doesn't have are left out, as the fallback query's projection would.
+    """
+    return {field: part[field] for field in LOOKUP_FIELDS[key] if field in part}
+
+
+async def _upsert_with_retry(semaphore, container, document, response_hook=None):
+    """
+    Upsert a document, backing off and retrying while Cosmos DB throttles the request.
+    response_hook, if given, is called with the response headers of the successful upsert.
+    """
+    return await _with_retry(semaphore, container.upsert_item, document, response_hook=response_hook)
 
-    client = CosmosClient.from_connection_string(os.getenv("COSMOS_CONNECTION_STRING"))
 
-    databaseName = os.getenv("CONFIGURATION__AZURECOSMOSDB__DATABASENAME", "cosmicworks")
-    database = client.get_database_client(databaseName)
+async def _upsert_lookup(semaphore, container, lookup, response_hook=None):
+    """
+    Write a lookup document unless its part number belongs to a catalog whose
+    brand_product sorts first, so a part listed in several catalogs resolves to the
+    same one whatever order they are uploaded in. The write only succeeds if the
+    document is unchanged since it was read, and is attempted again otherwise.
+    """
+    while True:
+        try:
+            current = await _with_retry(semaphore, container.read_item, lookup["id"], partition_key=lookup["id"], response_hook=response_hook)
+        except CosmosResourceNotFoundError:
+            try:
+                return await _with_retry(semaphore, container.create_item, lookup, response_hook=response_hook)
+            except CosmosResourceExistsError:
+                continue
+        
+        if current["brand_product"] < lookup["brand_product"]:
+            return current
+        try:
+            return await _with_retry(
+                semaphore, container.replace_item, current, lookup,
+                etag=current["_etag"], match_condition=MatchConditions.IfNotModified, response_hook=response_hook
+            )
+        except CosmosAccessConditionFailedError:
+            continue
+
+
+async def _delete_stale_lookups(semaphore, container, brand_product, part_numbers, response_hook=None):
+    """Delete the lookup documents brand_product owns for parts not in part_numbers."""
+    stale = [
+        item
+        async for item in container.query_items(
+            query=CATALOG_LOOKUPS_QUERY,
+            parameters=[{"name": "@brand_product", "value": brand_product}],
+            enable_scan_in_query=True
+        )
+        if item["id"] not in part_numbers
+    ]
+    await asyncio.gather(*[
+        _delete_with_retry(semaphore, container, item["id"], item["id"], response_hook, etag=item["_etag"])
+        for item in stale
+    ])
+
+
+async def _delete_with_retry(semaphore, container, item, partition_key, response_hook=None, etag=None):
+    """
+    Delete a document like _upsert_with_retry; a document that is already gone is not
+    an error. With etag, a document that has changed since it was read is left alone.
+    """
+    try:
+        await _with_retry(
+            semaphore, container.delete_item, item, partition_key=partition_key,
+            etag=etag, match_condition=MatchConditions.IfNotModified if etag else None, response_hook=response_hook
+        )
+    except (CosmosResourceNotFoundError, CosmosAccessConditionFailedError):
+        pass
+
+
+async def _with_retry(semaphore, request, *args, **kwargs):
+    """Make a Cosmos DB request, backing off and retrying while it is throttled (429)."""
+    async with semaphore:
+        for attempt in range(UPLOAD_MAX_RETRIES + 1):
+            try:
+                return await request(*args, **kwargs)
+            except CosmosHttpResponseError as e:
+                if e.status_code != 429 or attempt == UPLOAD_MAX_RETRIES:
+                    raise
+                # Prefer the server's hint, otherwise back off exponentially
+                retry_after_ms = (getattr(e, "headers", None) or {}).get("x-ms-retry-after-ms")
+                delay = float(retry_after_ms) / 1000 if retry_after_ms else 0.1 * 2 ** attempt
+                await asyncio.sleep(delay)
+
+
+def runDemo(writeOutput):
+    database = get_database()
 
     writeOutput(f"Get database:\t{database.id}")
 
-    containerName = os.getenv("CONFIGURATION__AZURECOSMOSDB__CONTAINERNAME", "products")
-    container = database.get_container_client(containerName)
+    container = get_container()
 
     writeOutput(f"Get container:\t{container.id}")
 
+    ensure_products_indexing_policy(database, container)
+
     # Original demo code for reference
     new_item = {
         "id": "aaaaaaaa-0000-1111-2222-bbbbbbbbbbbb",
@@ -129,7 +659,7 @@ def runDemo(writeOutput):
     )
 
     items = [{"id": item["id"], "brand_product": item["brand_product"]} for item in results]
-    output = json.dumps(items, indent=2)
+    output = orjson.dumps(items, option=orjson.OPT_INDENT_2).decode()
 
     writeOutput("Uploaded parts catalogs: ")
     writeOutput(output, isCode=True)
@@ -148,21 +678,16 @@ def test_upload_json_files(writeOutput=None):
             print(message)
         writeOutput = log_output
     
-    load_dotenv()
-    
-    client = CosmosClient.from_connection_string(os.getenv("COSMOS_CONNECTION_STRING"))
-    
-    databaseName = os.getenv("CONFIGURATION__AZURECOSMOSDB__DATABASENAME", "cosmicworks")
-    database = client.get_database_client(databaseName)
+    database = get_database()
+    container = get_container()
     
-    containerName = os.getenv("CONFIGURATION__AZURECOSMOSDB__CONTAINERNAME", "products")
-    container = database.get_container_client(containerName)
+    writeOutput(f"Connected to database: {database.id}, container: {container.id}")
     
-    writeOutput(f"Connected to database: {database.id}, container: {containerName}")
+    ensure_products_indexing_policy(database, container)
     
     # Upload all JSON files from data directory
     data_dir = "./scraper/data"
-    upload_stats = upload_json_files_to_cosmos(container, data_dir, writeOutput)
+    upload_stats = upload_json_files_to_cosmos(container, data_dir, writeOutput, include_ru=True)
     
     # Print summary
     writeOutput("\nUpload Summary:")
@@ -199,32 +724,19 @@ def run_cosmos_queries(writeOutput=None):
     if writeOutput is None:
         writeOutput = print
     
-    load_dotenv()
-    
     # Connect to Cosmos DB
-    client = CosmosClient.from_connection_string(os.getenv("COSMOS_CONNECTION_STRING"))
-    
-    databaseName = os.getenv("CONFIGURATION__AZURECOSMOSDB__DATABASENAME", "cosmicworks")
-    database = client.get_database_client(databaseName)
-    
-    containerName = os.getenv("CONFIGURATION__AZURECOSMOSDB__CONTAINERNAME", "products")
-    container = database.get_container_client(containerName)
+    database = get_database()
+    container = get_container()
     
     writeOutput("Connected to CosmosDB")
-    writeOutput(f"Database: {database.id}, Container: {containerName}")
+    writeOutput(f"Database: {database.id}, Container: {container.id}")
     writeOutput("-" * 80)
     
     # Query 1: List all Dacor Refrigerator parts
     writeOutput("QUERY 1: List all Dacor Refrigerator parts")
-    query1 = """
-    SELECT p.brand_product, item.name, item.manufacturer_number, item.partselect_number, item.price
-    FROM products p
-    JOIN item IN p.parts
-    WHERE p.brand_product LIKE 'Dacor-Refrigerator%'
-    """
-    
     items1 = list(container.query_items(
-        query=query1,
+        query=PARTS_BY_BRAND_PRODUCT_QUERY,
+        parameters=[{"name": "@brand_product_prefix", "value": "Dacor-Refrigerator"}],
         enable_cross_partition_query=True
     ))
     
@@ -239,58 +751,27 @@ def run_cosmos_queries(writeOutput=None):
     
     # Query 2: Find item of partselect_number=PS8728568
     writeOutput("QUERY 2: Find item with partselect_number=PS8728568")
-    query2 = """
-    SELECT p.brand_product, 
-        item.name,
-        item.url,
-        item.description,
-        item.partselect_number,
-        item.manufacturer_number,
-        item.price,
-        item.stock_status,
-        item.details
-    FROM products p
-    JOIN item IN p.parts
-    WHERE item.partselect_number = 'PS8728568'
-    """
-
-    items2 = list(container.query_items(
-        query=query2,
-        enable_cross_partition_query=True
-    ))
+    item2 = find_part_by_partselect_number("PS8728568")
 
-    if items2:
+    if item2:
         writeOutput(f"Found item with partselect_number PS8728568:")
-        writeOutput(json.dumps(items2[0], indent=2), isCode=True)
+        writeOutput(orjson.dumps(item2, option=orjson.OPT_INDENT_2).decode(), isCode=True)
     else:
         writeOutput("No item found with partselect_number PS8728568")
     
     # Query 3: Find item with manufacturer_number=WR23X37285 and return specific fields
     writeOutput("QUERY 3: Find item with manufacturer_number=WR23X37285")
-    query3 = """
-    SELECT p.brand_product, 
-           item.name, 
-           item.details.reviews_count,
-           item.details.reviews
-    FROM products p
-    JOIN item IN p.parts
-    WHERE item.manufacturer_number = 'WR23X37285'
-    """
-    
-    items3 = list(container.query_items(
-        query=query3,
-        enable_cross_partition_query=True
-    ))
+    item3 = find_part_reviews_by_manufacturer_number("WR23X37285")
     
-    if items3:
+    if item3:
         writeOutput(f"Found item with manufacturer_number WR23X37285:")
         result = {
-            "brand_product": items3[0]["brand_product"],
-            "name": items3[0]["name"],
-            "reviews_count": items3[0].get("reviews_count"),
-            "reviews": items3[0].get("reviews")
+            "brand_product": item3["brand_product"],
+            "name": item3["name"],
+            "reviews_count": item3.get("reviews_count"),
+            "reviews": item3.get("reviews")
         }
-        writeOutput(json.dumps(result, indent=2), isCode=True)
+        writeOutput(orjson.dumps(result, option=orjson.OPT_INDENT_2).decode(), isCode=True)
     else:
         writeOutput("No item found with manufacturer_number WR23X37285")
 
@@ -1,14 +1,24 @@
 # Copyright (c) Microsoft. All rights reserved.
 
 import asyncio
+import atexit
+import collections
+import functools
 import os
-from typing import Annotated, Dict, Any, Optional, Callable
+import threading
+import types
+from typing import Annotated, Any, Optional, Callable
 
 from azure.identity.aio import DefaultAzureCredential
 from semantic_kernel.agents import AzureAIAgent, AzureAIAgentSettings
 from semantic_kernel.functions import kernel_function
 from dotenv import load_dotenv
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 load_dotenv()
 
 """
@@ -16,16 +26,119 @@ Azure AI Agent implementation that provides part information and installation he
 This simple agent handles all customer inquiries without routing between specialized agents.
 """
 
-# Store agents and threads by user ID
-_agents: Dict[str, AzureAIAgent] = {}
-_threads: Dict[str, Any] = {}
+# Credential and Azure AI client shared by every user. Building them resolves the
+# credential chain and opens a new connection pool, so they are created once, on
+# first use inside the running event loop, and reused afterwards.
+_credential: Optional[DefaultAzureCredential] = None
+_client = None
+_client_lock = asyncio.Lock()
 
-class PartsPlugin:
-    """Plugin for appliance parts information and troubleshooting."""
 
-    @kernel_function(description="Provides information about common refrigerator parts.")
-    def get_refrigerator_parts(self) -> Annotated[str, "Returns common refrigerator parts."]:
-        return """
+async def get_client():
+    """Return the shared Azure AI client, creating it on first use."""
+    global _credential, _client
+    async with _client_lock:
+        if _client is None:
+            _credential = DefaultAzureCredential()
+            _client = AzureAIAgent.create_client(credential=_credential)
+        return _client
+
+
+async def close_client() -> None:
+    """Close the shared Azure AI client and credential."""
+    global _credential, _client
+    async with _client_lock:
+        if _client is not None:
+            await _client.close()
+            await _credential.close()
+            _client = None
+            _credential = None
+
+
+# Event loop used by the synchronous wrappers. It runs on a daemon thread for the life
+# of the process, so the shared client, its connection pool and cached tokens survive
+# between calls instead of being torn down by asyncio.run each time.
+# uvloop is used when installed (it isn't available on Windows).
+_loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, daemon=True).start()
+
+atexit.register(lambda: asyncio.run_coroutine_threadsafe(close_client(), _loop).result(timeout=10))
+
+# Maximum number of users whose agent and thread are kept in memory
+AGENT_CACHE_SIZE = int(os.getenv("AGENT_CACHE_SIZE", 512))
+
+
+class _AgentCache:
+    """
+    LRU map of user ID -> (agent, thread). When the cap is exceeded, the least recently
+    used entry is dropped and its agent and thread are deleted on the service in the
+    background, so neither local memory nor service-side agents grow without bound.
+    """
+
+    def __init__(self, capacity: int):
+        self._entries: "collections.OrderedDict[str, tuple]" = collections.OrderedDict()
+        self._capacity = capacity
+        self._lock = asyncio.Lock()
+        # Per-user locks held while a user's agent is created; dropped once it is stored
+        self._setup_locks = {}
+        self._evictions = set()
+
+    async def get(self, user_id: str) -> Optional[tuple]:
+        async with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+            return entry
+
+    def setup_lock(self, user_id: str) -> asyncio.Lock:
+        """Return the lock under which user_id's agent is created."""
+        return self._setup_locks.setdefault(user_id, asyncio.Lock())
+
+    async def put(self, user_id: str, agent: AzureAIAgent, thread: Any) -> None:
+        async with self._lock:
+            # Requests still waiting on the setup lock hold their own reference and
+            # find this entry once they get it
+            self._setup_locks.pop(user_id, None)
+            self._entries[user_id] = (agent, thread)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self._capacity:
+                _, (evicted_agent, evicted_thread) = self._entries.popitem(last=False)
+                # Keep a reference so the task isn't garbage collected before it finishes
+                task = asyncio.create_task(self._evict(evicted_agent, evicted_thread))
+                self._evictions.add(task)
+                task.add_done_callback(self._evictions.discard)
+
+    async def update_thread(self, user_id: str, agent: AzureAIAgent, thread: Any) -> None:
+        """
+        Store thread as user_id's thread, but only if the entry still holds agent. An entry
+        that was cleared or evicted meanwhile has had its agent deleted on the service and
+        must not be brought back.
+        """
+        async with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] is agent:
+                self._entries[user_id] = (agent, thread)
+
+    async def pop(self, user_id: str) -> Optional[tuple]:
+        async with self._lock:
+            return self._entries.pop(user_id, None)
+
+    @staticmethod
+    async def _evict(agent: AzureAIAgent, thread: Any) -> None:
+        try:
+            client = await get_client()
+            if thread:
+                await thread.delete()
+            await client.agents.delete_agent(agent.id)
+        except Exception as e:
+            print(f"Error deleting evicted agent: {str(e)}")
+
+
+# Store agents and threads by user ID
+_sessions = _AgentCache(AGENT_CACHE_SIZE)
+
+# Tool results that never change are built once at import rather than on every call
+REFRIGERATOR_PARTS = """
         Common Refrigerator Parts:
         1. Water Filter (PS8728568) - $49.99
         2. Door Gasket (PS9865421) - $89.95
@@ -34,9 +147,7 @@ class PartsPlugin:
         5. Ice Maker Assembly (PS4526781) - $129.95
         """
 
-    @kernel_function(description="Provides information about common dishwasher parts.")
-    def get_dishwasher_parts(self) -> Annotated[str, "Returns common dishwasher parts."]:
-        return """
+DISHWASHER_PARTS = """
         Common Dishwasher Parts:
         1. Spray Arm (PS2376541) - $35.99
         2. Pump and Motor (PS8812645) - $129.50
@@ -45,64 +156,92 @@ class PartsPlugin:
         5. Water Inlet Valve (PS5432198) - $65.99
         """
 
+
+# Simple mapping of part numbers to installation guides (read-only)
+_GUIDES = types.MappingProxyType({
+    "PS8728568": "Water Filter Installation:\n1. Turn off water supply\n2. Twist old filter counterclockwise to remove\n3. Insert new filter and twist clockwise until it locks\n4. Run water for 5 minutes to flush system",
+    "PS9865421": "Door Gasket Installation:\n1. Remove old gasket by pulling it away from the door\n2. Clean the channel thoroughly\n3. Start at the top corner and press new gasket into channel\n4. Work your way around the door, ensuring gasket is fully seated",
+    "PS2376541": "Spray Arm Installation:\n1. Remove lower dish rack\n2. Unscrew central mounting nut\n3. Remove old spray arm\n4. Align and place new spray arm\n5. Secure with mounting nut"
+})
+
+_DEFAULT_GUIDE = "No specific installation guide available for part {part_number}. Please refer to the manufacturer's manual or contact customer service."
+
+
+@functools.lru_cache(maxsize=1024)
+def _installation_guide(part_number: str) -> str:
+    """Look up the installation guide for part_number; repeated lookups are served from the cache."""
+    guide = _GUIDES.get(part_number)
+    return guide if guide is not None else _DEFAULT_GUIDE.format(part_number=part_number)
+
+
+# Model number help pages by appliance keyword, checked in order
+_MODEL_URLS = {
+    "refrigerator": "https://www.partselect.com/Find-Your-Refrigerator-Model-Number/",
+    "dishwasher": "https://www.partselect.com/Find-Your-Dishwasher-Model-Number/",
+}
+_DEFAULT_MODEL_URL = "https://www.partselect.com/model-number-faq/"
+
+
+class PartsPlugin:
+    """Plugin for appliance parts information and troubleshooting."""
+
+    @kernel_function(description="Provides information about common refrigerator parts.")
+    def get_refrigerator_parts(self) -> Annotated[str, "Returns common refrigerator parts."]:
+        return REFRIGERATOR_PARTS
+
+    @kernel_function(description="Provides information about common dishwasher parts.")
+    def get_dishwasher_parts(self) -> Annotated[str, "Returns common dishwasher parts."]:
+        return DISHWASHER_PARTS
+
     @kernel_function(description="Provides installation instructions for a part.")
     def get_installation_guide(self, part_number: Annotated[str, "The part number"]) -> Annotated[str, "Installation instructions"]:
-        # Simple mapping of part numbers to installation guides
-        guides = {
-            "PS8728568": "Water Filter Installation:\n1. Turn off water supply\n2. Twist old filter counterclockwise to remove\n3. Insert new filter and twist clockwise until it locks\n4. Run water for 5 minutes to flush system",
-            "PS9865421": "Door Gasket Installation:\n1. Remove old gasket by pulling it away from the door\n2. Clean the channel thoroughly\n3. Start at the top corner and press new gasket into channel\n4. Work your way around the door, ensuring gasket is fully seated",
-            "PS2376541": "Spray Arm Installation:\n1. Remove lower dish rack\n2. Unscrew central mounting nut\n3. Remove old spray arm\n4. Align and place new spray arm\n5. Secure with mounting nut"
-        }
-        
-        return guides.get(
-            part_number, 
-            f"No specific installation guide available for part {part_number}. Please refer to the manufacturer's manual or contact customer service."
-        )
+        return _installation_guide(part_number)
     
     @kernel_function(description="Provides URL to help find model number.")
     def get_model_number_help_url(self, appliance_type: Annotated[str, "Type of appliance"]) -> Annotated[str, "Help URL"]:
         appliance_type = appliance_type.lower()
-        
-        if "refrigerator" in appliance_type:
-            return "https://www.partselect.com/Find-Your-Refrigerator-Model-Number/"
-        elif "dishwasher" in appliance_type:
-            return "https://www.partselect.com/Find-Your-Dishwasher-Model-Number/"
-        else:
-            return "https://www.partselect.com/model-number-faq/"
+        return next((url for appliance, url in _MODEL_URLS.items() if appliance in appliance_type), _DEFAULT_MODEL_URL)
 
 
 async def get_or_create_agent(user_id: str) -> tuple:
     """Get existing agent or create a new one for the user."""
-    if user_id not in _agents or user_id not in _threads:
-        async with DefaultAzureCredential() as creds, AzureAIAgent.create_client(credential=creds) as client:
-            # Create agent on the Azure AI agent service
-            agent_definition = await client.agents.create_agent(
-                model=AzureAIAgentSettings().model_deployment_name,
-                name="Parts Assistant",
-                instructions="""
-                You are a helpful assistant for a parts service company. Your job is to:
-                1. Help users identify the parts they need for their appliances
-                2. Provide installation instructions when asked
-                3. Direct users to resources for finding their model numbers
-                
-                When users need help finding their model number, use the get_model_number_help_url function.
-                For refrigerator parts, use the get_refrigerator_parts function.
-                For dishwasher parts, use the get_dishwasher_parts function.
-                When users need installation help, use the get_installation_guide function.
-                
-                Be friendly but professional. Focus on helping users find exactly what they need.
-                """,
-            )
-
-            # Create agent instance
-            _agents[user_id] = AzureAIAgent(
-                client=client,
-                definition=agent_definition,
-                plugins=[PartsPlugin()],
-            )
-            _threads[user_id] = None
+    entry = await _sessions.get(user_id)
+    if entry is None:
+        # Concurrent first requests from the same user wait here, so only one creates the agent
+        async with _sessions.setup_lock(user_id):
+            # Another request may have created it while this one waited
+            entry = await _sessions.get(user_id)
+            if entry is None:
+                client = await get_client()
+                # Create agent on the Azure AI agent service
+                agent_definition = await client.agents.create_agent(
+                    model=AzureAIAgentSettings().model_deployment_name,
+                    name="Parts Assistant",
+                    instructions="""
+                    You are a helpful assistant for a parts service company. Your job is to:
+                    1. Help users identify the parts they need for their appliances
+                    2. Provide installation instructions when asked
+                    3. Direct users to resources for finding their model numbers
+            
+                    When users need help finding their model number, use the get_model_number_help_url function.
+                    For refrigerator parts, use the get_refrigerator_parts function.
+                    For dishwasher parts, use the get_dishwasher_parts function.
+                    When users need installation help, use the get_installation_guide function.
+            
+                    Be friendly but professional. Focus on helping users find exactly what they need.
+                    """,
+                )
+
+                # Create agent instance
+                agent = AzureAIAgent(
+                    client=client,
+                    definition=agent_definition,
+                    plugins=[PartsPlugin()],
+                )
+                entry = (agent, None)
+                await _sessions.put(user_id, *entry)
     
-    return _agents[user_id], _threads[user_id]
+    return entry
 
 
 async def query_agent(message: str, user_id: str, output_callback: Optional[Callable] = None) -> str:
@@ -124,8 +263,8 @@ async def query_agent(message: str, user_id: str, output_callback: Optional[Call
         # Get or create agent for this user
         agent, thread = await get_or_create_agent(user_id)
         
-        # Invoke the agent and capture the response
-        response_text = ""
+        # Invoke the agent and capture the response; chunks are joined once at the end
+        response_parts = []
         
         output_callback("Processing your request...")
         
@@ -133,16 +272,16 @@ async def query_agent(message: str, user_id: str, output_callback: Optional[Call
             messages=message,
             thread=thread,
         ):
-            # Update the response text
-            response_text += str(response)
+            # Collect the response text
+            response_parts.append(str(response))
             
             # Update the thread reference
             thread = response.thread
             
-        # Update the thread dictionary
-        _threads[user_id] = thread
+        # Update the stored thread
+        await _sessions.update_thread(user_id, agent, thread)
         
-        return response_text
+        return "".join(response_parts)
         
     except Exception as e:
         error_message = f"Error processing request: {str(e)}"
@@ -162,19 +301,15 @@ async def clear_context(user_id: str, output_callback: Optional[Callable] = None
         output_callback = print
     
     try:
-        # Check if the user has active agent and thread
-        if user_id in _agents:
+        # Remove the user's agent and thread, if any
+        entry = await _sessions.pop(user_id)
+        if entry is not None:
+            agent, thread = entry
             # Delete the thread if it exists
-            if user_id in _threads and _threads[user_id]:
-                async with DefaultAzureCredential() as creds, AzureAIAgent.create_client(credential=creds) as client:
-                    await _threads[user_id].delete()
-                    await client.agents.delete_agent(_agents[user_id].id)
-            
-            # Remove agent and thread from dictionaries
-            if user_id in _agents:
-                del _agents[user_id]
-            if user_id in _threads:
-                del _threads[user_id]
+            if thread:
+                client = await get_client()
+                await thread.delete()
+                await client.agents.delete_agent(agent.id)
             
             message = f"Conversation history cleared for user {user_id}"
             output_callback(message)
@@ -200,7 +335,7 @@ def query_semantic_kernel(user_query: str, user_id: str, output_callback: Option
         user_id: Unique identifier for the user
         output_callback: Function to call with output from the agent
     """
-    return asyncio.run(query_agent(user_query, user_id, output_callback))
+    return asyncio.run_coroutine_threadsafe(query_agent(user_query, user_id, output_callback), _loop).result()
 
 
 def clear_conversation_history(user_id: str, output_callback: Optional[Callable] = None) -> str:
@@ -211,7 +346,7 @@ def clear_conversation_history(user_id: str, output_callback: Optional[Callable]
         user_id: Unique identifier for the user
         output_callback: Function to call with output messages
     """
-    return asyncio.run(clear_context(user_id, output_callback))
+    return asyncio.run_coroutine_threadsafe(clear_context(user_id, output_callback), _loop).result()
 
 
 # For testing the agent directly
@@ -235,4 +370,4 @@ async def demo():
 
 if __name__ == "__main__":
     # Run demo when executed directly
-    asyncio.run(demo())
\ No newline at end of file
+    asyncio.run_coroutine_threadsafe(demo(), _loop).result()
\ No newline at end of file
@@ -1,16 +1,30 @@
 import asyncio
-import json
+import atexit
+import orjson
+from collections import OrderedDict
+from contextlib import AsyncExitStack
 from typing import Annotated, List, Dict, Any, Optional, Callable
 import os
+import re
+import threading
+import time
 
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.cosmos.aio import CosmosClient
 from azure.identity.aio import DefaultAzureCredential
 from semantic_kernel.functions import kernel_function
 from semantic_kernel.agents import AzureAIAgent, AzureAIAgentSettings
 
-# Import cosmos functions for database access
-from cosmos import CosmosClient
+# Import cosmos settings for database access
+from cosmos import COSMOS_DATABASE, COSMOS_CONTAINER
 from dotenv import load_dotenv
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 load_dotenv()
 
 """
@@ -20,9 +34,381 @@ Multi-agent system for parts selection service with three specialized agents:
 3. Information Agent: Provides installation guidance and answers FAQs
 """
 
+# Maximum number of users whose agents and thread are kept in memory
+AGENT_STORE_SIZE = int(os.getenv("AGENT_STORE_SIZE", 10000))
+
+
+class LruAgentStore:
+    """
+    LRU map of user ID -> (agents, thread). When the cap is exceeded, the least recently
+    used user is dropped and their thread and agents are deleted on the service in the
+    background, so neither local memory nor service-side resources grow without bound.
+    Each stored user also has a setup lock, dropped together with their entry.
+    """
+
+    def __init__(self, capacity):
+        self._entries = OrderedDict()
+        self._setup_locks = {}
+        self._capacity = capacity
+        # Keep references to running eviction tasks so they aren't garbage collected
+        self._evictions = set()
+
+    def __contains__(self, user_id):
+        return user_id in self._entries
+
+    def __getitem__(self, user_id):
+        self._entries.move_to_end(user_id)
+        return self._entries[user_id]
+
+    def __setitem__(self, user_id, entry):
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self._capacity:
+            evicted_user_id, (agents, thread) = self._entries.popitem(last=False)
+            self._setup_locks.pop(evicted_user_id, None)
+            task = asyncio.get_running_loop().create_task(self._evict(agents, thread))
+            self._evictions.add(task)
+            task.add_done_callback(self._evictions.discard)
+
+    def is_current(self, user_id, agents):
+        """
+        Whether user_id's entry still holds agents. An entry that was cleared or evicted
+        has had its agents deleted on the service and must not be brought back.
+        """
+        entry = self._entries.get(user_id)
+        return entry is not None and entry[0] is agents
+
+    def update_thread(self, user_id, agents, thread):
+        """Store thread as user_id's thread, if the entry still holds agents."""
+        if self.is_current(user_id, agents):
+            self._entries[user_id] = (agents, thread)
+
+    def pop(self, user_id, default=None):
+        self._setup_locks.pop(user_id, None)
+        return self._entries.pop(user_id, default)
+
+    def setup_lock(self, user_id):
+        """
+        Return the lock under which user_id's agents are created, so concurrent requests
+        from the same user create each agent only once.
+        """
+        lock = self._setup_locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            # A user no longer in the store gets a throwaway lock instead of a new entry
+            if user_id in self._entries:
+                self._setup_locks[user_id] = lock
+        return lock
+
+    @staticmethod
+    async def _evict(agents, thread):
+        try:
+            client = await get_ai_client()
+            if thread:
+                await thread.delete()
+            # get_user_agent deletes any agent it finishes creating for an evicted user
+            # itself, so these are all of the user's agents
+            for agent in list(agents.values()):
+                await client.agents.delete_agent(agent.id)
+        except Exception as e:
+            print(f"Error deleting evicted agents: {str(e)}")
+
+
 # Store agent instances and conversation threads by user ID
-_agents = {}
-_threads = {}
+_sessions = LruAgentStore(AGENT_STORE_SIZE)
+
+# Connections the Cosmos client keeps open; aiohttp's default is 100 shared across
+# all hosts, sized here to the expected query concurrency instead
+COSMOS_POOL_SIZE = int(os.getenv("COSMOS_POOL_SIZE", 64))
+
+# Async Cosmos client shared by the plugins. It is bound to the event loop it was
+# created in, so it is created on first use inside the running loop.
+_cosmos_client: Optional[CosmosClient] = None
+_container = None
+_container_lock = asyncio.Lock()
+
+
+async def _get_container():
+    """Return the shared async products container client, creating it on first use."""
+    global _cosmos_client, _container
+    async with _container_lock:
+        if _container is None:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=COSMOS_POOL_SIZE))
+            _cosmos_client = CosmosClient.from_connection_string(
+                os.getenv("COSMOS_CONNECTION_STRING"),
+                # Session consistency gives read-your-writes per client at a fraction
+                # of the latency and RU cost of Strong
+                consistency_level="Session",
+                transport=AioHttpTransport(session=session, session_owner=True),
+            )
+            _container = _cosmos_client.get_database_client(COSMOS_DATABASE).get_container_client(COSMOS_CONTAINER)
+        return _container
+
+
+def _dumps(obj):
+    """Serialize a plugin result to a JSON string with orjson."""
+    return orjson.dumps(obj).decode()
+
+
+# Process-wide caps on concurrent agent invocations and Cosmos DB queries, so a
+# burst of users queues here instead of exhausting connections or the RU budget
+_LLM_SEM = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENT_LLM", 8)))
+_DB_SEM = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENT_DB", 32)))
+
+# Maximum number of parts returned by a brand search
+SEARCH_RESULT_LIMIT = 10
+
+
+# Parts fetched by PartSelect number are kept for PART_CACHE_TTL seconds, so the
+# details, installation and FAQ lookups a conversation makes about the same part
+# share one Cosmos DB read. The least recently used part is evicted past PART_CACHE_SIZE.
+PART_CACHE_SIZE = int(os.getenv("PART_CACHE_SIZE", 2048))
+PART_CACHE_TTL = float(os.getenv("PART_CACHE_TTL", 300))
+_part_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+# Query text is defined once and values are always bound as parameters, so every
+# call sends identical text and Cosmos DB can reuse the cached query plan
+_Q_SEARCH_BY_BRAND = """
+SELECT p.brand_product, item.name, item.manufacturer_number, item.partselect_number, item.price, item.description
+FROM products p
+JOIN item IN p.parts
+WHERE STARTSWITH(p.brand_product, @brand_product)
+"""
+
+# Only the fields the kernel functions read; reviews and repair stories make up most
+# of a part document and are fetched separately when asked for. Catalog parts are
+# flat, so every field is read at item level. installation_guide and faqs are not in
+# the scraped catalogs and are only returned for parts that have them.
+_Q_PARTS = """
+SELECT p.brand_product, {
+    "name": item.name,
+    "url": item.url,
+    "image_url": item.image_url,
+    "description": item.description,
+    "partselect_number": item.partselect_number,
+    "manufacturer_number": item.manufacturer_number,
+    "price": item.price,
+    "stock_status": item.stock_status,
+    "rating": item.rating,
+    "reviews_count": item.reviews_count,
+    "symptoms_fixed": item.symptoms_fixed,
+    "works_with": item.works_with,
+    "also_replaces": item.also_replaces,
+    "video_url": item.video_url,
+    "installation_guide": item.installation_guide,
+    "faqs": item.faqs
+} AS item
+FROM products p
+JOIN item IN p.parts
+WHERE ARRAY_CONTAINS(@partselect_numbers, item.partselect_number)
+"""
+
+_Q_PART_REVIEWS = """
+SELECT TOP 1 VALUE item.reviews
+FROM products p
+JOIN item IN p.parts
+WHERE item.partselect_number = @partselect_number
+"""
+
+# Fields each kernel function returns, mapped to their path within a part
+_PART_DETAILS_FIELDS = {
+    "name": ("name",),
+    "url": ("url",),
+    "image_url": ("image_url",),
+    "description": ("description",),
+    "partselect_number": ("partselect_number",),
+    "manufacturer_number": ("manufacturer_number",),
+    "price": ("price",),
+    "stock_status": ("stock_status",),
+    "rating": ("rating",),
+    "reviews_count": ("reviews_count",),
+    "symptoms_fixed": ("symptoms_fixed",),
+    "works_with": ("works_with",),
+    "also_replaces": ("also_replaces",),
+    "video_url": ("video_url",),
+}
+# The part's video on PartSelect is its installation video
+_INSTALLATION_FIELDS = {
+    "name": ("name",),
+    "installation_guide": ("installation_guide",),
+    "installation_video_url": ("video_url",),
+}
+_FAQ_FIELDS = {
+    "name": ("name",),
+    "faqs": ("faqs",),
+}
+
+
+# Part lookups arriving within this window are sent to Cosmos DB as one query
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW_MS", 10)) / 1000
+
+
+class RequestCoalescer:
+    """
+    Batches concurrent part lookups. The first lookup in a window schedules a flush;
+    every lookup until then joins the batch (sharing a future with any lookup of the
+    same number), and the flush fetches the whole batch with a single query.
+    """
+
+    def __init__(self, window):
+        self._window = window
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def fetch(self, partselect_number):
+        """Return the record for partselect_number, or None if there is no such part."""
+        future = self._pending.get(partselect_number)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._pending[partselect_number] = loop.create_future()
+            if self._flush_task is None:
+                self._flush_task = loop.create_task(self._flush())
+        # Shielded so one caller being cancelled doesn't cancel the lookup for the others
+        return await asyncio.shield(future)
+
+    async def _flush(self):
+        await asyncio.sleep(self._window)
+        batch, self._pending = self._pending, {}
+        self._flush_task = None
+        
+        records = {}
+        try:
+            container = await _get_container()
+            async with _DB_SEM:
+                async for record in container.query_items(
+                    query=_Q_PARTS,
+                    parameters=[{"name": "@partselect_numbers", "value": list(batch)}],
+                    max_item_count=len(batch)
+                ):
+                    # A part listed in several catalogs is returned once per catalog
+                    records.setdefault(record["item"]["partselect_number"], record)
+                    if len(records) == len(batch):
+                        break
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for partselect_number, future in batch.items():
+            if not future.done():
+                future.set_result(records.get(partselect_number))
+
+
+_part_fetcher = RequestCoalescer(COALESCE_WINDOW)
+
+
+async def _fetch_part(partselect_number):
+    """
+    Return {"brand_product": ..., "item": <part>} for a PartSelect number, or None if
+    there is no such part. Found parts are served from the cache while fresh.
+    """
+    now = time.monotonic()
+    cached = _part_cache.get(partselect_number)
+    if cached is not None and cached[0] > now:
+        _part_cache.move_to_end(partselect_number)
+        return cached[1]
+    
+    record = await _part_fetcher.fetch(partselect_number)
+    
+    if record is not None:
+        _part_cache[partselect_number] = (now + PART_CACHE_TTL, record)
+        _part_cache.move_to_end(partselect_number)
+        if len(_part_cache) > PART_CACHE_SIZE:
+            _part_cache.popitem(last=False)
+    return record
+
+
+async def _fetch_part_reviews(partselect_number):
+    """Return the customer reviews for a part; not cached, as they are only read on request."""
+    container = await _get_container()
+    async with _DB_SEM:
+        async for reviews in container.query_items(
+            query=_Q_PART_REVIEWS,
+            parameters=[{"name": "@partselect_number", "value": partselect_number}],
+            max_item_count=1
+        ):
+            return reviews or []
+    return []
+
+
+def _project(record, fields):
+    """
+    Build a result from a fetched part: its brand_product plus the given fields.
+    Fields the part doesn't have are left out, as a query projection would.
+    """
+    result = {"brand_product": record["brand_product"]}
+    for key, path in fields.items():
+        value = record["item"]
+        for step in path:
+            if not isinstance(value, dict) or step not in value:
+                break
+            value = value[step]
+        else:
+            result[key] = value
+    return result
+
+
+async def _lookup_many(lookup, partselect_numbers):
+    """
+    Run lookup for every number in a comma-separated list of PartSelect numbers
+    concurrently, and return a dict mapping each number to its result. All lookups
+    are started at once, so the coalescer batches them into a single query.
+    """
+    numbers = list(dict.fromkeys(n.strip() for n in partselect_numbers.split(",") if n.strip()))
+    results = await asyncio.gather(*[lookup(n) for n in numbers])
+    return dict(zip(numbers, results))
+
+
+# Lookups shared by the single-part and bulk kernel functions. They return dicts so
+# each kernel function serializes its result once.
+async def _get_part_details(partselect_number):
+    try:
+        record = await _fetch_part(partselect_number)
+        if record is None:
+            return {"error": f"No part found with partselect_number {partselect_number}"}
+        
+        return _project(record, _PART_DETAILS_FIELDS)
+    except Exception as e:
+        return {"error": str(e)}
+
+
+async def _get_installation_guide(partselect_number):
+    try:
+        record = await _fetch_part(partselect_number)
+        if record is None:
+            return {"error": f"No installation guide found for part {partselect_number}"}
+        
+        result = _project(record, _INSTALLATION_FIELDS)
+        # If there is neither a guide nor a video, provide a generic response
+        if not result.get("installation_guide") and not result.get("installation_video_url"):
+            return {
+                "part_name": result.get("name", "Unknown part"),
+                "message": "No specific installation guide available for this part.",
+                "general_advice": "For installation assistance, please contact customer support or refer to the appliance manual."
+            }
+        
+        return result
+    except Exception as e:
+        return {"error": str(e)}
+
+
+async def close_cosmos_client():
+    """Close the shared async Cosmos client."""
+    global _cosmos_client, _container
+    async with _container_lock:
+        if _cosmos_client is not None:
+            await _cosmos_client.close()
+            _cosmos_client = None
+            _container = None
+
+# Model number help pages by appliance keyword, checked in order
+_MODEL_URLS = {
+    "refrigerator": "https://www.partselect.com/Find-Your-Refrigerator-Model-Number/",
+    "dishwasher": "https://www.partselect.com/Find-Your-Dishwasher-Model-Number/",
+}
+_DEFAULT_MODEL_URL = "https://www.partselect.com/model-number-faq/"
+
 
 class TriagePlugin:
     """Plugin that helps the Triage agent determine which specialized agent to use."""
@@ -42,7 +428,7 @@ class RetailPlugin:
     """Plugin for the Retail agent to help users find the correct parts."""
     
     @kernel_function(description="Searches for parts by model or brand.")
-    def search_parts_by_brand_model(
+    async def search_parts_by_brand_model(
         self, 
         brand_product: Annotated[str, "Brand and product type, e.g., 'Dacor-Refrigerator'"]
     ) -> Annotated[str, "JSON list of parts for the specified brand and product"]:
@@ -51,33 +437,30 @@ class RetailPlugin:
         Example: search_parts_by_brand_model("Dacor-Refrigerator")
         """
         try:
-            # Connect to Cosmos DB
-            client = CosmosClient.from_connection_string(os.getenv("COSMOS_CONNECTION_STRING"))
-            database = client.get_database_client(os.getenv("CONFIGURATION__AZURECOSMOSDB__DATABASENAME", "cosmicworks"))
-            container = database.get_container_client(os.getenv("CONFIGURATION__AZURECOSMOSDB__CONTAINERNAME", "products"))
-            
-            # Query to find parts by brand and product
-            query = f"""
-            SELECT p.brand_product, item.name, item.manufacturer_number, item.partselect_number, item.price, item.description
-            FROM products p
-            JOIN item IN p.parts
-            WHERE p.brand_product LIKE '{brand_product}%'
-            """
+            # Shared container client; the connection pool is reused across calls
+            container = await _get_container()
             
-            items = list(container.query_items(
-                query=query,
-                enable_cross_partition_query=True
-            ))
+            # Stop reading once enough parts are found instead of buffering every match
+            items = []
+            async with _DB_SEM:
+                async for item in container.query_items(
+                    query=_Q_SEARCH_BY_BRAND,
+                    parameters=[{"name": "@brand_product", "value": brand_product}],
+                    max_item_count=SEARCH_RESULT_LIMIT
+                ):
+                    items.append(item)
+                    if len(items) == SEARCH_RESULT_LIMIT:  # Limit parts for readability
+                        break
             
             if not items:
-                return json.dumps({"error": f"No parts found for {brand_product}", "parts": []})
+                return _dumps({"error": f"No parts found for {brand_product}", "parts": []})
             
-            return json.dumps({"parts": items[:10]})  # Limit to 10 parts for readability
+            return _dumps({"parts": items})
         except Exception as e:
-            return json.dumps({"error": str(e), "parts": []})
+            return _dumps({"error": str(e), "parts": []})
 
     @kernel_function(description="Gets detailed information about a specific part by its PartSelect number.")
-    def get_part_details(
+    async def get_part_details(
         self, 
         partselect_number: Annotated[str, "The PartSelect number of the part, e.g., 'PS8728568'"]
     ) -> Annotated[str, "JSON object with detailed information about the part"]:
@@ -85,39 +468,18 @@ class RetailPlugin:
         Gets detailed information about a specific part by its PartSelect number.
         Example: get_part_details("PS8728568")
         """
-        try:
-            # Connect to Cosmos DB
-            client = CosmosClient.from_connection_string(os.getenv("COSMOS_CONNECTION_STRING"))
-            database = client.get_database_client(os.getenv("CONFIGURATION__AZURECOSMOSDB__DATABASENAME", "cosmicworks"))
-            container = database.get_container_client(os.getenv("CONFIGURATION__AZURECOSMOSDB__CONTAINERNAME", "products"))
-            
-            # Query to find part by partselect_number
-            query = f"""
-            SELECT p.brand_product, 
-                item.name,
-                item.url,
-                item.description,
-                item.partselect_number,
-                item.manufacturer_number,
-                item.price,
-                item.stock_status,
-                item.details
-            FROM products p
-            JOIN item IN p.parts
-            WHERE item.partselect_number = '{partselect_number}'
-            """
-            
-            items = list(container.query_items(
-                query=query,
-                enable_cross_partition_query=True
-            ))
-            
-            if not items:
-                return json.dumps({"error": f"No part found with partselect_number {partselect_number}"})
-            
-            return json.dumps(items[0])
-        except Exception as e:
-            return json.dumps({"error": str(e)})
+        return _dumps(await _get_part_details(partselect_number))
+    
+    @kernel_function(description="Gets detailed information about several parts at once by their PartSelect numbers.")
+    async def get_parts_details_bulk(
+        self, 
+        partselect_numbers: Annotated[str, "Comma-separated PartSelect numbers, e.g., 'PS8728568,PS9865421'"]
+    ) -> Annotated[str, "JSON object mapping each PartSelect number to its details"]:
+        """
+        Gets detailed information about several parts, looking them up concurrently.
+        Example: get_parts_details_bulk("PS8728568,PS9865421")
+        """
+        return _dumps(await _lookup_many(_get_part_details, partselect_numbers))
     
     @kernel_function(description="Gets a URL to help user find their appliance model number.")
     def get_model_number_help_url(
@@ -128,112 +490,64 @@ class RetailPlugin:
         Gets a URL to help the user find their appliance model number.
         """
         appliance_type = appliance_type.lower()
-        
-        if "refrigerator" in appliance_type:
-            return "https://www.partselect.com/Find-Your-Refrigerator-Model-Number/"
-        elif "dishwasher" in appliance_type:
-            return "https://www.partselect.com/Find-Your-Dishwasher-Model-Number/"
-        else:
-            return "https://www.partselect.com/model-number-faq/"
+        return next((url for appliance, url in _MODEL_URLS.items() if appliance in appliance_type), _DEFAULT_MODEL_URL)
 
 
 class InformationPlugin:
     """Plugin for the Information agent to provide installation guidance and FAQs."""
     
     @kernel_function(description="Gets installation instructions for a specific part.")
-    def get_installation_guide(
+    async def get_installation_guide(
         self, 
         partselect_number: Annotated[str, "The PartSelect number of the part, e.g., 'PS8728568'"]
     ) -> Annotated[str, "Installation guide for the specified part"]:
         """
         Gets installation instructions for a specific part by partselect_number.
         """
-        try:
-            # Connect to Cosmos DB
-            client = CosmosClient.from_connection_string(os.getenv("COSMOS_CONNECTION_STRING"))
-            database = client.get_database_client(os.getenv("CONFIGURATION__AZURECOSMOSDB__DATABASENAME", "cosmicworks"))
-            container = database.get_container_client(os.getenv("CONFIGURATION__AZURECOSMOSDB__CONTAINERNAME", "products"))
-            
-            # Query to find installation instructions
-            query = f"""
-            SELECT p.brand_product, 
-                item.name,
-                item.description,
-                item.details.installation_guide,
-                item.details.installation_video_url
-            FROM products p
-            JOIN item IN p.parts
-            WHERE item.partselect_number = '{partselect_number}'
-            """
-            
-            items = list(container.query_items(
-                query=query,
-                enable_cross_partition_query=True
-            ))
-            
-            if not items:
-                return json.dumps({"error": f"No installation guide found for part {partselect_number}"})
-            
-            result = items[0]
-            
-            # If no installation guide in the data, provide a generic response
-            if not result.get("installation_guide"):
-                return json.dumps({
-                    "part_name": result.get("name", "Unknown part"),
-                    "message": "No specific installation guide available for this part.",
-                    "general_advice": "For installation assistance, please contact customer support or refer to the appliance manual."
-                })
-                
-            return json.dumps(result)
-        except Exception as e:
-            return json.dumps({"error": str(e)})
+        return _dumps(await _get_installation_guide(partselect_number))
+    
+    @kernel_function(description="Gets installation instructions for several parts at once.")
+    async def get_installation_guides_bulk(
+        self, 
+        partselect_numbers: Annotated[str, "Comma-separated PartSelect numbers, e.g., 'PS8728568,PS9865421'"]
+    ) -> Annotated[str, "JSON object mapping each PartSelect number to its installation guide"]:
+        """
+        Gets installation instructions for several parts, looking them up concurrently.
+        """
+        return _dumps(await _lookup_many(_get_installation_guide, partselect_numbers))
     
     @kernel_function(description="Gets frequently asked questions about a specific part.")
-    def get_part_faqs(
+    async def get_part_faqs(
         self, 
-        partselect_number: Annotated[str, "The PartSelect number of the part, e.g., 'PS8728568'"]
+        partselect_number: Annotated[str, "The PartSelect number of the part, e.g., 'PS8728568'"],
+        include_reviews: Annotated[bool, "Whether to also return customer reviews of the part"] = False
     ) -> Annotated[str, "FAQs for the specified part"]:
         """
-        Gets FAQs for a specific part by partselect_number.
+        Gets FAQs for a specific part by partselect_number, with its customer reviews if requested.
         """
         try:
-            # Connect to Cosmos DB
-            client = CosmosClient.from_connection_string(os.getenv("COSMOS_CONNECTION_STRING"))
-            database = client.get_database_client(os.getenv("CONFIGURATION__AZURECOSMOSDB__DATABASENAME", "cosmicworks"))
-            container = database.get_container_client(os.getenv("CONFIGURATION__AZURECOSMOSDB__CONTAINERNAME", "products"))
-            
-            # Query to find FAQs
-            query = f"""
-            SELECT p.brand_product, 
-                item.name,
-                item.details.faqs,
-                item.details.reviews
-            FROM products p
-            JOIN item IN p.parts
-            WHERE item.partselect_number = '{partselect_number}'
-            """
-            
-            items = list(container.query_items(
-                query=query,
-                enable_cross_partition_query=True
-            ))
+            record = await _fetch_part(partselect_number)
+            result = _project(record, _FAQ_FIELDS) if record is not None else None
             
-            if not items:
-                return json.dumps({"error": f"No FAQs found for part {partselect_number}"})
+            if result is None:
+                return _dumps({"error": f"No FAQs found for part {partselect_number}"})
             
-            result = items[0]
+            if include_reviews:
+                result["reviews"] = await _fetch_part_reviews(partselect_number)
             
             # If no FAQs in the data, provide a generic response
             if not result.get("faqs"):
-                return json.dumps({
+                response = {
                     "part_name": result.get("name", "Unknown part"),
                     "message": "No specific FAQs available for this part.",
-                    "reviews": result.get("reviews", [])
-                })
+                }
+                if include_reviews:
+                    response["reviews"] = result["reviews"]
+                return _dumps(response)
                 
-            return json.dumps(result)
+            return _dumps(result)
         except Exception as e:
-            return json.dumps({"error": str(e)})
+            return _dumps({"error": str(e)})
 
 
 async def create_agent(client, name, instructions, plugins=None):
@@ -253,11 +567,8 @@ async def create_agent(client, name, instructions, plugins=None):
     return agent
 
 
-async def setup_agents(client):
-    """Set up all three agents and return them as a dictionary."""
-    
-    # 1. Triage Agent
-    triage_instructions = """
+# Instructions for each agent
+TRIAGE_INSTRUCTIONS = """
     You are a helpful triage agent for a parts service company. Your job is to:
     1. Greet users professionally
     2. Determine what kind of help they need
@@ -273,15 +584,8 @@ async def setup_agents(client):
 
     When you determine which agent should help, say: "I'll connect you with our [agent type] to assist with that."
     """
-    triage_agent = await create_agent(
-        client, 
-        "Triage Agent", 
-        triage_instructions,
-        plugins=[TriagePlugin()]
-    )
 
-    # 2. Retail Agent
-    retail_instructions = """
+RETAIL_INSTRUCTIONS = """
     You are a helpful retail agent for a parts service company. Your job is to:
     1. Help users identify the exact part they need for their appliance
     2. Provide detailed information about parts including price, availability, and specifications
@@ -291,74 +595,146 @@ async def setup_agents(client):
     - If users don't know their model number, provide them with a relevant URL to help them find it
     - Use the search_parts_by_brand_model function to look up available parts
     - Use the get_part_details function to get detailed information about specific parts
+    - Use the get_parts_details_bulk function when the user asks about several parts at once
     - Your job is complete when the user has confirmed the correct part they need and you have the exact partselect_number
     
     If users need help with installation or have questions about a part they already own,
     let them know they should speak with our Information Agent instead.
     """
-    retail_agent = await create_agent(
-        client, 
-        "Retail Agent", 
-        retail_instructions,
-        plugins=[RetailPlugin()]
-    )
 
-    # 3. Information Agent
-    info_instructions = """
+INFO_INSTRUCTIONS = """
     You are a helpful information agent for a parts service company. Your job is to:
     1. Provide installation guidance for specific parts
     2. Answer FAQs about parts and appliances
     3. Help troubleshoot common issues
     
     Use the get_installation_guide function to find installation instructions for specific parts.
+    Use the get_installation_guides_bulk function when the user asks about several parts at once.
     Use the get_part_faqs function to find FAQs and common questions about specific parts.
+    Only set its include_reviews argument when the user asks what other customers say about a part.
     
     If the user is trying to identify which part they need or wants to purchase a part,
     let them know they should speak with our Retail Agent instead.
     """
-    info_agent = await create_agent(
-        client, 
-        "Information Agent", 
-        info_instructions,
-        plugins=[InformationPlugin()]
-    )
-    
-    return {
-        "triage": triage_agent,
-        "retail": retail_agent,
-        "info": info_agent
-    }
+
+# The plugins hold no per-user state, so every user's agents share one instance of each
+_TRIAGE_PLUGIN = TriagePlugin()
+_RETAIL_PLUGIN = RetailPlugin()
+_INFO_PLUGIN = InformationPlugin()
+
+# Name, instructions and plugin of each agent type. A user's agents are created
+# from these one at a time, the first time a message is routed to that type, so users
+# that only ever talk to one specialist never pay for the other two.
+_AGENT_SPECS = {
+    "triage": ("Triage Agent", TRIAGE_INSTRUCTIONS, _TRIAGE_PLUGIN),
+    "retail": ("Retail Agent", RETAIL_INSTRUCTIONS, _RETAIL_PLUGIN),
+    "info": ("Information Agent", INFO_INSTRUCTIONS, _INFO_PLUGIN),
+}
+
+
+async def setup_agent(client, agent_type):
+    """Create the agent of the given type: "triage", "retail" or "info"."""
+    name, instructions, plugin = _AGENT_SPECS[agent_type]
+    return await create_agent(client, name, instructions, plugins=[plugin])
+
+
+# Credential and Azure AI client shared by every user. The agents created with the
+# client keep using it after setup, so it stays open until close_ai_client is called.
+_ai_stack: Optional[AsyncExitStack] = None
+_ai_client = None
+_ai_client_lock = asyncio.Lock()
+
+
+async def get_ai_client():
+    """Return the shared Azure AI client, creating it and its credential on first use."""
+    global _ai_stack, _ai_client
+    async with _ai_client_lock:
+        if _ai_client is None:
+            stack = AsyncExitStack()
+            try:
+                creds = await stack.enter_async_context(DefaultAzureCredential())
+                _ai_client = await stack.enter_async_context(AzureAIAgent.create_client(credential=creds))
+            except Exception:
+                await stack.aclose()
+                raise
+            _ai_stack = stack
+        return _ai_client
+
+
+async def close_ai_client():
+    """Close the shared Azure AI client and credential."""
+    global _ai_stack, _ai_client
+    async with _ai_client_lock:
+        if _ai_stack is not None:
+            await _ai_stack.aclose()
+            _ai_stack = None
+            _ai_client = None
 
 
 async def init_conversation_context(user_id):
-    """Initialize conversation context for a user."""
-    if user_id not in _agents or user_id not in _threads:
-        async with (
-            DefaultAzureCredential() as creds,
-            AzureAIAgent.create_client(credential=creds) as client,
-        ):
-            _agents[user_id] = await setup_agents(client)
-            _threads[user_id] = None
+    """Initialize conversation context for a user. Agents are created on first use."""
+    if user_id not in _sessions:
+        _sessions[user_id] = ({}, None)
             
-    return _agents[user_id], _threads[user_id]
-
-
-async def determine_agent_type(message):
+    return _sessions[user_id]
+
+
+async def get_user_agent(user_id, agents, agent_type):
+    """Return the user's agent of agent_type, creating it on first use."""
+    if agent_type not in agents:
+        async with _sessions.setup_lock(user_id):
+            # Another request may have created it while this one waited
+            if agent_type not in agents:
+                client = await get_ai_client()
+                agent = await setup_agent(client, agent_type)
+                # The user may have been evicted or cleared while the agent was created,
+                # after their agents were deleted; nothing would delete this one later
+                if not _sessions.is_current(user_id, agents):
+                    await client.agents.delete_agent(agent.id)
+                    raise RuntimeError("The conversation was cleared while its agent was being set up, please try again")
+                agents[agent_type] = agent
+    return agents[agent_type]
+
+
+_WORD_RE = re.compile(r"\w+")
+
+# Installation or troubleshooting related terms. Messages are matched word by word,
+# so the inflections and prefixed forms the old substring match caught are listed explicitly.
+_INFO_TERMS = frozenset({
+    "install", "installs", "installed", "installing", "installation", "installations",
+    "installer", "installers", "preinstalled",
+    "uninstall", "uninstalls", "uninstalled", "uninstalling", "uninstallation",
+    "reinstall", "reinstalls", "reinstalled", "reinstalling", "reinstallation",
+    "steps", "guide", "guides", "guided", "instructions", "broken", "issue", "issues",
+    "problem", "problems", "fix", "fixes", "fixed", "fixing", "unfixable",
+    "repair", "repairs", "repaired", "repairing", "repairable",
+})
+_INFO_PHRASES = frozenset({("how", "to"), ("help", "me"), ("not", "working")})
+
+# Part selection or identification related terms
+_RETAIL_TERMS = frozenset({
+    "find", "finding", "finds", "part", "parts", "need", "needs", "needed", "needing",
+    "buy", "buying", "buys", "purchase", "purchases", "purchased", "purchasing",
+    "repurchase", "order", "orders", "ordered", "ordering", "reorder", "reordering",
+    "replacement", "replacements", "model", "models", "number", "numbers",
+    "price", "prices", "priced", "cost", "costs", "costing", "costly",
+})
+_RETAIL_PHRASES = frozenset({
+    ("looking", "for"),
+    ("refrigerator", "part"), ("refrigerator", "parts"),
+    ("dishwasher", "part"), ("dishwasher", "parts"),
+})
+
+
+def determine_agent_type(message):
     """Simple logic to determine which agent should handle a message."""
-    message_lower = message.lower()
-    
-    # Installation or troubleshooting related terms
-    info_terms = ["install", "how to", "steps", "guide", "help me", "instructions", 
-                  "broken", "not working", "issue", "problem", "fix", "repair"]
-                  
-    # Part selection or identification related terms
-    retail_terms = ["find", "part", "need", "looking for", "buy", "purchase", 
-                    "order", "replacement", "model", "number", "refrigerator part",
-                    "dishwasher part", "price", "cost"]
+    words = _WORD_RE.findall(message.lower())
+    tokens = set(words)
+    pairs = set(zip(words, words[1:]))
     
     # Count matches
-    info_count = sum(1 for term in info_terms if term in message_lower)
-    retail_count = sum(1 for term in retail_terms if term in message_lower)
+    info_count = len(tokens & _INFO_TERMS) + len(pairs & _INFO_PHRASES)
+    retail_count = len(tokens & _RETAIL_TERMS) + len(pairs & _RETAIL_PHRASES)
     
     # Default to triage agent for initial interaction
     if info_count == 0 and retail_count == 0:
@@ -388,28 +764,29 @@ async def query_multi_agent(message, user_id, output_callback=None):
         agents, thread = await init_conversation_context(user_id)
         
         # Determine which agent should handle this message
-        agent_type = await determine_agent_type(message)
-        current_agent = agents[agent_type]
+        agent_type = determine_agent_type(message)
+        current_agent = await get_user_agent(user_id, agents, agent_type)
         
-        # Capture the response
-        response_text = ""
+        # Capture the response; chunks are joined once at the end
+        response_parts: List[str] = []
         output_callback(f"Agent type: {agent_type.capitalize()}")
         
         # Invoke the agent and capture the response
-        async for response in current_agent.invoke(
-            messages=message,
-            thread=thread,
-        ):
-            # Accumulate the response
-            response_text += str(response)
-            
-            # Update the thread reference
-            thread = response.thread
-            
-            # Update the thread dictionary
-            _threads[user_id] = thread
+        async with _LLM_SEM:
+            async for response in current_agent.invoke(
+                messages=message,
+                thread=thread,
+            ):
+                # Accumulate the response
+                response_parts.append(str(response))
+                
+                # Update the thread reference
+                thread = response.thread
+                
+                # Update the stored thread
+                _sessions.update_thread(user_id, agents, thread)
         
-        return response_text
+        return "".join(response_parts)
             
     except Exception as e:
         error_message = f"Error processing request: {str(e)}"
@@ -429,18 +806,13 @@ async def clear_user_context(user_id, output_callback=None):
         output_callback = print
         
     try:
-        # Check if the user has active agents and thread
-        if user_id in _agents:
+        # Check if the user has active agents and thread, removing them from the store
+        entry = _sessions.pop(user_id)
+        if entry is not None:
+            _, thread = entry
             # Delete the thread if it exists
-            if user_id in _threads and _threads[user_id]:
-                async with DefaultAzureCredential() as creds, AzureAIAgent.create_client(credential=creds) as client:
-                    await _threads[user_id].delete()
-                    
-            # Remove agents and thread from dictionaries
-            if user_id in _agents:
-                del _agents[user_id]
-            if user_id in _threads:
-                del _threads[user_id]
+            if thread:
+                await thread.delete()
                 
             output_callback(f"Conversation context cleared for user {user_id}")
         else:
@@ -452,15 +824,30 @@ async def clear_user_context(user_id, output_callback=None):
         return error_message
 
 
+# Event loop used by the synchronous wrappers. It runs on a daemon thread for the life
+# of the process, so the shared Cosmos and Azure AI clients and the stored agents stay
+# bound to a live loop between calls instead of being torn down by asyncio.run each time.
+# uvloop is used when installed (it isn't available on Windows).
+_loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, daemon=True).start()
+
+
+async def _close_clients():
+    await close_cosmos_client()
+    await close_ai_client()
+
+atexit.register(lambda: asyncio.run_coroutine_threadsafe(_close_clients(), _loop).result(timeout=10))
+
+
 def query_multi_agent_sync(message, user_id, output_callback=None):
     """
     Synchronous wrapper for query_multi_agent.
     """
-    return asyncio.run(query_multi_agent(message, user_id, output_callback))
+    return asyncio.run_coroutine_threadsafe(query_multi_agent(message, user_id, output_callback), _loop).result()
 
 
 def clear_user_context_sync(user_id, output_callback=None):
     """
     Synchronous wrapper for clear_user_context.
     """
-    return asyncio.run(clear_user_context(user_id, output_callback))
\ No newline at end of file
+    return asyncio.run_coroutine_threadsafe(clear_user_context(user_id, output_callback), _loop).result()
\ No newline at end of file